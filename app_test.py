@@ -8,9 +8,11 @@ config.get_global_config().flagged_off.append('stats')
 
 import app
 import mock
+import MySQLdb
 
 import time
 import datetime
+import sqlite3
 import unittest
 
 class CitationHuntTest(unittest.TestCase):
@@ -171,5 +173,68 @@ class CitationHuntTest(unittest.TestCase):
         self.assertTrue((now - normalized) > datetime.timedelta(hours = 23))
         self.assertTrue((now - normalized) < datetime.timedelta(hours = 25))
 
+class SQLiteCursor(object):
+    '''Wraps a sqlite3 cursor to take MySQLdb's %s placeholders and raise
+    its exceptions for missing tables, and counts the queries made.'''
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.queries = 0
+
+    def execute(self, sql, args = ()):
+        self.queries += 1
+        try:
+            return self._cursor.execute(sql.replace('%s', '?'), args)
+        except sqlite3.OperationalError as e:
+            raise MySQLdb.ProgrammingError(str(e))
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+class QueryNextIdTest(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.addCleanup(self.db.close)
+        self.db.execute('''
+            CREATE TABLE category_sizes (cat_id TEXT, cat_num INTEGER,
+            size INTEGER)''')
+        self.db.execute('''
+            CREATE TABLE snippets_positions (cat_num INTEGER, pos INTEGER,
+            snippet_id TEXT)''')
+        self.db.executemany('INSERT INTO category_sizes VALUES (?, ?, ?)',
+            [('c1', 0, 3), ('c2', 1, 1)])
+        self.db.executemany('INSERT INTO snippets_positions VALUES (?, ?, ?)',
+            [(0, 0, 'a'), (0, 1, 'b'), (0, 2, 'c'), (1, 0, 'b')])
+
+        self.cursor = SQLiteCursor(self.db.cursor())
+        patcher = mock.patch('handlers.citationhunt.get_db',
+            return_value = mock.Mock(cursor = lambda: self.cursor))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(
+            app.handlers.citationhunt._langs_without_snippets_links.clear)
+
+        context = app.app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
+    def query_next_id(self, curr_id, cat_id):
+        return app.handlers.Database.query_next_id('en', curr_id, cat_id)
+
+    def test_next_id(self):
+        self.assertEquals(self.query_next_id('a', 'c1'), ('b',))
+        self.assertEquals(self.query_next_id('b', 'c1'), ('c',))
+
+    def test_next_id_wraps_around(self):
+        self.assertEquals(self.query_next_id('c', 'c1'), ('a',))
+        self.assertEquals(self.query_next_id('b', 'c2'), ('b',))
+
+    def test_next_id_not_in_category(self):
+        # Falls back to the missing snippets_links table only once
+        self.assertEquals(self.query_next_id('a', 'c2'), None)
+        self.assertEquals(self.cursor.queries, 2)
+        self.assertEquals(self.query_next_id('c', 'c2'), None)
+        self.assertEquals(self.cursor.queries, 3)
+
 if __name__ == '__main__':
     unittest.main()
@@ -8,6 +8,28 @@ import contextlib
 ch_my_cnf = op.join(op.dirname(op.realpath(__file__)), 'ch.my.cnf')
 wp_my_cnf = op.join(op.dirname(op.realpath(__file__)), 'wp.my.cnf')
 
+# (table, column, referenced table and column) for each foreign key. When
+# building the scratch database in bulk, these are only added after all data
+# has been loaded.
+_FOREIGN_KEYS = [
+    ('articles_categories', 'article_id', 'articles(page_id)'),
+    ('articles_categories', 'category_id', 'categories(id)'),
+    ('category_article_count', 'category_id', 'categories(id)'),
+    ('snippets', 'article_id', 'articles(page_id)'),
+    ('snippets_positions', 'snippet_id', 'snippets(id)'),
+    ('category_sizes', 'cat_id', 'categories(id)'),
+]
+
+# (table, columns) for each secondary index other than those of the foreign
+# keys, which are also only added after loading when building in bulk.
+_KEYS = [
+    ('snippets_positions', 'snippet_id, cat_num'),
+]
+
+# How many values to look up at a time with IN (...), to keep queries and
+# their result sets small
+IN_CHUNK_SIZE = 1000
+
 class RetryingConnection(object):
     '''
     Wraps a MySQLdb connection, handling retries as needed.
@@ -59,6 +81,15 @@ def ignore_warnings():
     yield
     warnings.resetwarnings()
 
+def in_chunks(values, chunk_size = IN_CHUNK_SIZE):
+    '''Splits `values` into chunks, yielding each chunk along with a
+    '(%s,%s,...)' string of placeholders to use with IN for it.'''
+
+    values = list(values)
+    for i in range(0, len(values), chunk_size):
+        chunk = values[i:i+chunk_size]
+        yield chunk, '(' + ','.join(['%s'] * len(chunk)) + ')'
+
 def _connect(config_file):
     return MySQLdb.connect(charset = 'utf8mb4', read_default_file = config_file)
 
@@ -89,6 +120,9 @@ def init_scratch_db():
     def connect_and_initialize():
         db = _connect(ch_my_cnf)
         _ensure_database(db, 'scratch', cfg.lang_code)
+        if cfg.scratch_db_bulk_load:
+            with db as cursor:
+                cursor.execute('SET SESSION unique_checks = 0')
         return db
     return RetryingConnection(connect_and_initialize)
 
@@ -149,18 +183,56 @@ def reset_scratch_db():
             cursor.execute('DROP DATABASE IF EXISTS ' + dbname)
         cursor.execute('CREATE DATABASE %s CHARACTER SET utf8mb4' % dbname)
         cursor.execute('USE ' + dbname)
-    create_tables(db)
+    create_tables(db, foreign_keys = not cfg.scratch_db_bulk_load)
+    with db as cursor:
+        # The pages parse_live.py is done with, so interrupted runs can be
+        # resumed. This only exists in the scratch database.
+        cursor.execute('''
+            CREATE TABLE parse_live_checkpoint (page_id INT(8) UNSIGNED
+            PRIMARY KEY) ENGINE=InnoDB
+        ''')
     return db
 
+def copy_articles_to_scratch_db(page_ids):
+    '''Copies articles and their snippets from the live database to the
+    scratch database, checkpointing them as done for parse_live.py.'''
+
+    page_ids = list(page_ids)
+    if not page_ids:
+        return
+    cfg = config.get_localized_config()
+    db = init_scratch_db()
+    chname = _make_tools_labs_dbname(db, 'citationhunt', cfg.lang_code)
+
+    def copy(cursor, page_ids, in_page_ids):
+        cursor.execute('''
+            INSERT IGNORE INTO articles SELECT * FROM %s.articles
+            WHERE page_id IN %s''' % (chname, in_page_ids), page_ids)
+        cursor.execute('''
+            INSERT IGNORE INTO snippets SELECT * FROM %s.snippets
+            WHERE article_id IN %s''' % (chname, in_page_ids), page_ids)
+        cursor.executemany('''
+            INSERT IGNORE INTO parse_live_checkpoint VALUES (%s)''',
+            [(p,) for p in page_ids])
+    for chunk, in_page_ids in in_chunks(page_ids):
+        db.execute_with_retry(copy, chunk, in_page_ids)
+
 def install_scratch_db():
     cfg = config.get_localized_config()
     db = init_db(cfg.lang_code)
     # ensure citationhunt is populated with tables
     create_tables(db)
 
+    scratch_db = init_scratch_db()
+    if not has_foreign_keys(scratch_db):
+        add_foreign_keys(scratch_db)
+
     chname = _make_tools_labs_dbname(db, 'citationhunt', cfg.lang_code)
     scname = _make_tools_labs_dbname(db, 'scratch', cfg.lang_code)
     with db as cursor:
+        cursor.execute(
+            'DROP TABLE IF EXISTS %s.parse_live_checkpoint' % scname)
+
         # generate a sql query that will atomically swap tables in
         # 'citationhunt' and 'scratch'. Modified from:
         # http://blog.shlomoid.com/2010/02/emulating-missing-rename-database.html
@@ -175,10 +247,57 @@ def install_scratch_db():
 
         rename_stmt = cursor.fetchone()[0]
         cursor.execute(rename_stmt)
+        # snippets_links was replaced by snippets_positions and
+        # category_sizes, so it stays behind, referencing the old tables.
+        # Drop it now that the new tables are live, before its foreign keys
+        # can keep us from dropping the old tables below.
+        cursor.execute(
+            'DROP TABLE IF EXISTS %s.snippets_links' % chname)
         cursor.execute('DROP DATABASE ' + scname)
 
-def create_tables(db):
+def _keys_sql(table):
+    # The secondary indexes come first, so the foreign keys can use them
+    return ['KEY(%s)' % columns for t, columns in _KEYS if t == table] + [
+        'FOREIGN KEY(%s) REFERENCES %s ON DELETE CASCADE' % (column, ref)
+        for t, column, ref in _FOREIGN_KEYS if t == table]
+
+def _foreign_keys_sql(table):
+    return ''.join(', ' + key for key in _keys_sql(table))
+
+def has_foreign_keys(db):
+    '''Returns whether the tables in the current database of `db` have their
+    foreign keys, which depends on how they were created rather than on the
+    current configuration.'''
+
+    with db as cursor:
+        cursor.execute('''
+            SELECT COUNT(*) FROM information_schema.TABLE_CONSTRAINTS
+            WHERE table_schema = DATABASE() AND
+            constraint_type = 'FOREIGN KEY'
+        ''')
+        return cursor.fetchone()[0] > 0
+
+def add_foreign_keys(db):
+    '''Adds the foreign keys, and their indexes, to tables created with
+    create_tables(db, foreign_keys = False), along with the other secondary
+    indexes.
+    '''
+
+    tables = []
+    for table in [k[0] for k in _KEYS + _FOREIGN_KEYS]:
+        if table not in tables:
+            tables.append(table)
+    with db as cursor:
+        # Check the data as the keys are added, so an inconsistent database
+        # fails here instead of being installed
+        cursor.execute('SET SESSION foreign_key_checks = 1')
+        for table in tables:
+            cursor.execute('ALTER TABLE %s %s' % (table, ', '.join(
+                'ADD ' + key for key in _keys_sql(table))))
+
+def create_tables(db, foreign_keys = True):
     cfg = config.get_localized_config()
+    fks = _foreign_keys_sql if foreign_keys else lambda table: ''
     with db as cursor, ignore_warnings():
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS categories (id VARCHAR(128) PRIMARY KEY,
@@ -189,34 +308,42 @@ def create_tables(db):
         ''')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS articles (page_id INT(8) UNSIGNED
-            PRIMARY KEY, url VARCHAR(512), title VARCHAR(512))
+            PRIMARY KEY, url VARCHAR(512), title VARCHAR(512),
+            rev_id INT(10) UNSIGNED, content_hash CHAR(40))
             ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
         ''')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS articles_categories (
-            article_id INT(8) UNSIGNED, category_id VARCHAR(128),
-            FOREIGN KEY(article_id) REFERENCES articles(page_id)
-            ON DELETE CASCADE,
-            FOREIGN KEY(category_id) REFERENCES categories(id)
-            ON DELETE CASCADE) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            article_id INT(8) UNSIGNED, category_id VARCHAR(128)''' +
+            fks('articles_categories') + ''')
+            ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
         ''')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS category_article_count (
-            category_id VARCHAR(128), article_count INT(8) UNSIGNED,
-            FOREIGN KEY(category_id) REFERENCES categories(id)
-            ON DELETE CASCADE) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            category_id VARCHAR(128), article_count INT(8) UNSIGNED''' +
+            fks('category_article_count') + ''')
+            ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
         ''')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS snippets (id VARCHAR(128) PRIMARY KEY,
             snippet VARCHAR(%s), section VARCHAR(768), article_id INT(8)
-            UNSIGNED, FOREIGN KEY(article_id) REFERENCES articles(page_id)
-            ON DELETE CASCADE) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            UNSIGNED''' + fks('snippets') + ''')
+            ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
         ''', (cfg.snippet_max_size * 2,))
+        # The snippets in each category are numbered from 0 to the size of
+        # the category, in the order we want to show them, so the snippet
+        # after the one at position pos is the one at (pos + 1) % size.
+        # The categories are numbered too to keep this table small.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS category_sizes (
+            cat_id VARCHAR(128) PRIMARY KEY, cat_num INT(8) UNSIGNED,
+            size INT(8) UNSIGNED''' + fks('category_sizes') + ''')
+            ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        ''')
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS snippets_links (prev VARCHAR(128),
-            next VARCHAR(128), cat_id VARCHAR(128),
-            FOREIGN KEY(prev) REFERENCES snippets(id) ON DELETE CASCADE,
-            FOREIGN KEY(next) REFERENCES snippets(id) ON DELETE CASCADE,
-            FOREIGN KEY(cat_id) REFERENCES categories(id) ON DELETE CASCADE)
+            CREATE TABLE IF NOT EXISTS snippets_positions (
+            cat_num INT(8) UNSIGNED, pos INT(8) UNSIGNED,
+            snippet_id VARCHAR(128), PRIMARY KEY (cat_num, pos)''' +
+            fks('snippets_positions') + ''')
             ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
         ''')
@@ -14,11 +14,13 @@ import os
 # lists are merged. There is currently no way to completely override a base list
 # value.
 
+_ARCHIVE_DIR = os.path.join(os.path.expanduser('~'), 'ch_archives')
+
 # Configuration keys that don't correspond to user-visible or snippet parsing
 # behavior. Boring stuff.
 _GLOBAL_CONFIG = dict(
     # If running on Tools labs, keep database dumps in this directory...
-    archive_dir = os.path.join(os.path.expanduser('~'), 'ch_archives'),
+    archive_dir = _ARCHIVE_DIR,
 
     # ...and delete dumps that are older than this many days
     archive_duration_days = 90,
@@ -26,11 +28,72 @@ _GLOBAL_CONFIG = dict(
     # Where to put various logs
     log_dir = os.path.join(os.path.expanduser('~'), 'ch_logs'),
 
+    # Where to keep caches that are reused across runs, such as the HTML
+    # for snippets. Set to None to disable caching.
+    cache_dir = os.path.join(_ARCHIVE_DIR, 'cache'),
+
+    # How many snippets to keep in the HTML cache for each language
+    snippet_html_cache_max_entries = 500000,
+
+    # For how long to reuse the list of templates redirecting to the citation
+    # needed templates, before asking the API again
+    citation_needed_templates_cache_hours = 24,
+
+    # Whether to go to the Wikipedia API ('live'), record its responses in
+    # cache_dir ('record'), only replay the recorded responses ('replay'), or
+    # replay them and fetch and record anything else ('replay-or-fetch')
+    wikipedia_api_mode = 'live',
+
     flagged_off = [],
 
     profile = True,
 
+    # Whether the snippet parser should try to strip simple paragraphs without
+    # building a full parse tree. This doesn't change the output.
+    snippet_parser_fast_path = True,
+
+    # Pages with more wikitext than this many characters, or that take more
+    # than this many seconds of CPU time to parse, are skipped by
+    # parse_live.py and listed in a report in log_dir
+    parse_live_max_page_size = 2 * 1024 * 1024,
+    parse_live_max_page_cpu_seconds = 30,
+
+    # Whether parse_live.py should retry the pages it skipped at the end of
+    # the run, without the limits above
+    parse_live_retry_skipped_pages = True,
+
+    # parse_live.py fetches pages from the API in this many threads, parses
+    # them in this many processes (None means one per core), and writes the
+    # snippets to the database in batches of this many rows...
+    parse_live_fetch_threads = 8,
+    parse_live_parse_processes = None,
+    parse_live_write_batch_size = 1000,
+
+    # ...with at most this many batches of pages waiting to be parsed or
+    # written at any time
+    parse_live_max_pending_batches = 64,
+
+    # parse_live.py replaces each worker process after this many batches of
+    # pages, to get back the memory it used (None means never)
+    parse_live_max_tasks_per_worker = 100,
+
+    # After parse_live times out, for how long to keep writing the pages that
+    # were already being parsed, so they don't need to be parsed again when
+    # resuming
+    parse_live_drain_seconds = 120,
+
+    # Whether to build the scratch database without foreign keys and their
+    # indexes, and with unique checks off, adding the keys only right before
+    # installing it. This makes loading it much faster.
+    scratch_db_bulk_load = True,
+
     stats_max_age_days = 90,
+
+    # When looking for unsourced pages, don't go deeper than this many levels
+    # of subcategories below the citation needed category, or visit more than
+    # this many categories in total (None means no limit)
+    unsourced_category_max_depth = 10,
+    unsourced_category_max_categories = 50000,
 )
 
 # A base configuration that all languages "inherit" from.
@@ -45,6 +108,10 @@ _BASE_LANG_CONFIG = dict(
     # Wikipedia API before storing them in the database
     html_snippet = False,
 
+    # When html_snippet is True, whether snippets with simple markup (no
+    # templates or links) should be converted to HTML locally instead
+    html_snippet_local_rendering = True,
+
     # When html_snippet is True, the elements identified by these CSS selectors
     # are removed from the HTML returned by the Wikipedia API
     html_css_selectors_to_strip = [
@@ -0,0 +1,256 @@
+'''
+Readers for the Wikipedia database dumps at https://dumps.wikimedia.org/.
+
+The pages-articles-multistream.xml.bz2 dumps are made of many concatenated
+bzip2 streams of about 100 pages each, so they can be split into byte ranges
+and decompressed in parallel. Their index files tell which stream each page is
+in, so we can also decompress only the streams we need.
+
+The page.sql.gz and categorylinks.sql.gz dumps can be read directly too,
+without importing them into MySQL first.
+'''
+
+from __future__ import unicode_literals
+
+import os
+import sys
+
+_upper_dir = os.path.abspath(os.path.dirname(__file__))
+if _upper_dir not in sys.path:
+    sys.path.append(_upper_dir)
+
+from utils import *
+
+import bz2file
+import lxml.etree
+
+import array
+import gzip
+import io
+import itertools
+import operator
+import re
+
+# The start of a bzip2 stream: the stream header followed by the magic number
+# of its first block. Streams always start on a byte boundary.
+BZ2_STREAM_START_REGEXP = re.compile(b'BZh[1-9]1AY&SY')
+BZ2_STREAM_START_SIZE = 10
+
+# The column definitions in a CREATE TABLE statement
+SQL_COLUMN_REGEXP = re.compile(br'^\s+`(\w+)`')
+# The values in an INSERT statement
+SQL_VALUE_REGEXP = re.compile(br"'[^'\\]*(?:\\.[^'\\]*)*'|[^,()';\s]+")
+SQL_ESCAPE_REGEXP = re.compile(br'\\(.)', re.DOTALL)
+SQL_ESCAPES = {
+    b'0': b'\0', b'b': b'\b', b'n': b'\n', b'r': b'\r', b't': b'\t',
+    b'Z': b'\x1a',
+}
+
+CATEGORY_NAMESPACE = 14
+
+def split_multistream(path, chunk_size):
+    '''Splits a multistream dump into (start, end) byte ranges of roughly
+    `chunk_size` bytes, to be read with `read_multistream_range`.
+    '''
+
+    size = os.path.getsize(path)
+    return [(start, min(start + chunk_size, size))
+            for start in range(0, size, chunk_size)]
+
+def read_multistream_index(dump_path, index_path, pageids, chunk_size):
+    '''Returns the (start, end) byte ranges of the streams in a multistream
+    dump that contain any of `pageids`, to be read with
+    `read_multistream_range`.
+
+    The streams are found using the dump's multistream-index.txt.bz2 file,
+    which has one "offset:pageid:title" line per page. Consecutive streams
+    are merged into ranges of up to `chunk_size` bytes.
+    '''
+
+    offsets = [] # the start of each stream, in order
+    wanted = set() # the streams containing pageids
+    with bz2file.BZ2File(index_path) as f:
+        for line in f:
+            offset, pageid, _ = line.split(b':', 2)
+            offset = int(offset)
+            if not offsets or offsets[-1] != offset:
+                offsets.append(offset)
+            if pageid in pageids:
+                wanted.add(offset)
+
+    # The last stream in the index is followed by the footer, if anything
+    offsets.append(os.path.getsize(dump_path))
+    ranges = []
+    for start, end in zip(offsets, offsets[1:]):
+        if start not in wanted:
+            continue
+        if ranges and ranges[-1][1] == start and \
+            end - ranges[-1][0] <= chunk_size:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+def read_multistream_range(f, start, end, read_size = 1024 * 1024):
+    '''Returns the bytes of all bzip2 streams in the file `f` that start at an
+    offset in [start, end).
+
+    The returned streams may extend past `end`, and ranges that don't contain
+    the start of any stream return an empty string, so the ranges returned by
+    `split_multistream` cover each stream exactly once.
+    '''
+
+    f.seek(start)
+    data = f.read(end - start + BZ2_STREAM_START_SIZE - 1)
+    m = BZ2_STREAM_START_REGEXP.search(data)
+    if m is None or m.start() >= end - start:
+        return b''
+    first = m.start()
+
+    # Keep reading until the first stream that starts at or after `end`
+    search_from = first + 1
+    while True:
+        for m in BZ2_STREAM_START_REGEXP.finditer(data, search_from):
+            if m.start() >= end - start:
+                return data[first:m.start()]
+        search_from = max(
+            search_from, len(data) - BZ2_STREAM_START_SIZE + 1)
+        more = f.read(read_size)
+        if not more:
+            return data[first:]
+        data += more
+
+def _localname(tag):
+    return tag.rpartition('}')[2]
+
+def _page_to_tuple(page):
+    fields = {}
+    for child in page:
+        if isinstance(child.tag, basestring):
+            fields[_localname(child.tag)] = child
+    text = None
+    revid = None
+    if 'revision' in fields:
+        for child in fields['revision']:
+            if not isinstance(child.tag, basestring):
+                continue
+            if _localname(child.tag) == 'text':
+                text = child.text
+            elif _localname(child.tag) == 'id':
+                revid = int(child.text)
+    return (d(fields['id'].text), d(fields['title'].text), d(text or ''),
+            revid)
+
+def iter_pages(data, read_size = 1024 * 1024):
+    '''Yields a (pageid, title, wikitext, revision id) tuple for each page in
+    `data`, the bzip2 streams returned by `read_multistream_range`.
+
+    The XML is parsed incrementally as it is decompressed, and pages are
+    discarded once yielded, so memory use doesn't depend on the size of
+    `data`.
+    '''
+
+    if not data:
+        return
+
+    # The streams hold a sequence of <page> elements, plus the <mediawiki>
+    # header or footer at the start and end of the dump, so we add our own
+    # root element and recover from the unbalanced tags.
+    parser = lxml.etree.XMLPullParser(events = ('end',), recover = True)
+    parser.feed(b'<pages>')
+    with bz2file.BZ2File(io.BytesIO(data)) as f:
+        while True:
+            xml = f.read(read_size)
+            if not xml:
+                break
+            parser.feed(xml)
+            for _, element in parser.read_events():
+                if _localname(element.tag) != 'page':
+                    continue
+                yield _page_to_tuple(element)
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+def _sql_value(token):
+    if token[0] == b"'":
+        token = token[1:-1]
+        if b'\\' in token:
+            token = SQL_ESCAPE_REGEXP.sub(
+                lambda m: SQL_ESCAPES.get(m.group(1), m.group(1)), token)
+        return token
+    if token == b'NULL':
+        return None
+    try:
+        return int(token)
+    except ValueError:
+        return float(token)
+
+def iter_sql_dump_rows(path, columns):
+    '''Yields the rows in a gzipped MySQL dump of a single table, such as
+    page.sql.gz or categorylinks.sql.gz, as tuples with the values of the
+    columns named in `columns`.
+
+    Strings are returned as byte strings, since most columns in the
+    Wikipedia dumps are binary.
+    '''
+
+    table_columns = []
+    get_columns = None
+    with gzip.open(path) as f:
+        for line in f:
+            if not line.startswith(b'INSERT INTO '):
+                m = SQL_COLUMN_REGEXP.match(line)
+                if m is not None:
+                    table_columns.append(d(m.group(1)))
+                continue
+
+            if get_columns is None:
+                ncolumns = len(table_columns)
+                get_columns = operator.itemgetter(
+                    *[table_columns.index(c) for c in columns])
+            values = SQL_VALUE_REGEXP.findall(
+                line, line.index(b' VALUES ') + len(b' VALUES '))
+            for row in itertools.izip(*[iter(values)] * ncolumns):
+                row = get_columns(row)
+                if len(columns) == 1:
+                    row = (row,)
+                yield tuple(map(_sql_value, row))
+
+def load_page_titles(path, namespace, pageids = None):
+    '''Returns a dict page id -> title for the pages in `namespace` in a
+    page.sql.gz dump, optionally only for the pages in `pageids`.
+
+    Titles are byte strings with underscores instead of spaces, as in the
+    page table.
+    '''
+
+    titles = {}
+    for page_id, page_namespace, page_title in iter_sql_dump_rows(
+        path, ['page_id', 'page_namespace', 'page_title']):
+        if page_namespace != namespace:
+            continue
+        if pageids is None or page_id in pageids:
+            titles[page_id] = page_title
+    return titles
+
+def load_category_members(path, cl_type, categories = None):
+    '''Returns a dict category -> array of page ids with the members of type
+    `cl_type` ('page', 'subcat' or 'file') of each category in a
+    categorylinks.sql.gz dump, optionally only for the categories in
+    `categories`.
+
+    Category names are byte strings with underscores instead of spaces, as in
+    the categorylinks table.
+    '''
+
+    members = {}
+    for cl_from, cl_to, type in iter_sql_dump_rows(
+        path, ['cl_from', 'cl_to', 'cl_type']):
+        if type != cl_type:
+            continue
+        if categories is None or cl_to in categories:
+            if cl_to not in members:
+                members[cl_to] = array.array(b'L')
+            members[cl_to].append(cl_from)
+    return members
@@ -0,0 +1,162 @@
+from __future__ import unicode_literals
+
+import dumps
+
+import bz2
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+HEADER = (b'<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" '
+          b'xml:lang="en">\n  <siteinfo><sitename>W</sitename></siteinfo>\n')
+FOOTER = b'</mediawiki>\n'
+PAGE = (b'  <page>\n    <title>Page %d</title>\n    <ns>0</ns>\n'
+        b'    <id>%d</id>\n    <revision>\n      <id>%d</id>\n'
+        b'      <text xml:space="preserve">Text of page %d &amp; more</text>\n'
+        b'    </revision>\n  </page>\n')
+
+PAGE_SQL = b"""-- MySQL dump 10.16
+DROP TABLE IF EXISTS `page`;
+CREATE TABLE `page` (
+  `page_id` int(8) unsigned NOT NULL AUTO_INCREMENT,
+  `page_namespace` int(11) NOT NULL DEFAULT '0',
+  `page_title` varbinary(255) NOT NULL DEFAULT '',
+  `page_len` int(8) unsigned NOT NULL DEFAULT '0',
+  PRIMARY KEY (`page_id`),
+  UNIQUE KEY `name_title` (`page_namespace`,`page_title`)
+) ENGINE=InnoDB DEFAULT CHARSET=binary;
+INSERT INTO `page` VALUES (1,0,'Page_(one)',10),(2,14,'Unsourced',20),(3,14,'Caf\xc3\xa9s',30);
+INSERT INTO `page` VALUES (4,14,'Rock_\\\'n\\\'_roll',NULL);
+"""
+
+CATEGORYLINKS_SQL = b"""CREATE TABLE `categorylinks` (
+  `cl_from` int(8) unsigned NOT NULL DEFAULT '0',
+  `cl_to` varbinary(255) NOT NULL DEFAULT '',
+  `cl_sortkey` varbinary(230) NOT NULL DEFAULT '',
+  `cl_type` enum('page','subcat','file') NOT NULL DEFAULT 'page',
+  PRIMARY KEY (`cl_from`,`cl_to`)
+) ENGINE=InnoDB DEFAULT CHARSET=binary;
+INSERT INTO `categorylinks` VALUES (1,'Unsourced','PAGE,(ONE)','page'),(3,'Unsourced','\\0\\n','subcat');
+INSERT INTO `categorylinks` VALUES (1,'Caf\xc3\xa9s','','page'),(4,'Unsourced','','subcat');
+"""
+
+class SQLDumpTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp(prefix = 'citationhunt_dumps_test_')
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.page_dump = os.path.join(tmpdir, 'page.sql.gz')
+        with gzip.open(self.page_dump, 'wb') as f:
+            f.write(PAGE_SQL)
+        self.categorylinks_dump = os.path.join(tmpdir, 'categorylinks.sql.gz')
+        with gzip.open(self.categorylinks_dump, 'wb') as f:
+            f.write(CATEGORYLINKS_SQL)
+
+    def test_iter_sql_dump_rows(self):
+        self.assertEqual(
+            list(dumps.iter_sql_dump_rows(
+                self.page_dump, ['page_title', 'page_len'])),
+            [(b'Page_(one)', 10), (b'Unsourced', 20),
+             (b'Caf\xc3\xa9s', 30), (b"Rock_'n'_roll", None)])
+        self.assertEqual(
+            list(dumps.iter_sql_dump_rows(
+                self.categorylinks_dump, ['cl_sortkey']))[:2],
+            [(b'PAGE,(ONE)',), (b'\0\n',)])
+
+    def test_load_page_titles(self):
+        self.assertEqual(
+            dumps.load_page_titles(self.page_dump, dumps.CATEGORY_NAMESPACE),
+            {2: b'Unsourced', 3: b'Caf\xc3\xa9s', 4: b"Rock_'n'_roll"})
+        self.assertEqual(
+            dumps.load_page_titles(self.page_dump, 0, set([1, 2])),
+            {1: b'Page_(one)'})
+
+    def test_load_category_members(self):
+        members = dumps.load_category_members(
+            self.categorylinks_dump, 'subcat')
+        self.assertEqual(members.keys(), [b'Unsourced'])
+        self.assertEqual(list(members[b'Unsourced']), [3, 4])
+
+        members = dumps.load_category_members(
+            self.categorylinks_dump, 'page', set([b'Caf\xc3\xa9s']))
+        self.assertEqual(members.keys(), [b'Caf\xc3\xa9s'])
+        self.assertEqual(list(members[b'Caf\xc3\xa9s']), [1])
+
+class MultistreamDumpTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp(prefix = 'citationhunt_dumps_test_')
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'pages-articles-multistream.xml.bz2')
+
+        # Like the real dumps: a stream for the header, one for every few
+        # pages, and one for the footer
+        streams = [bz2.compress(HEADER)]
+        for i in range(1, 31, 3):
+            streams.append(bz2.compress(b''.join(
+                PAGE % (j, j, j + 1000, j) for j in range(i, i + 3))))
+        streams.append(bz2.compress(FOOTER))
+        with open(self.path, 'wb') as f:
+            f.write(b''.join(streams))
+
+        self.index_path = os.path.join(
+            tmpdir, 'pages-articles-multistream-index.txt.bz2')
+        index = []
+        offset = len(streams[0])
+        for i, stream in zip(range(1, 31, 3), streams[1:]):
+            for j in range(i, i + 3):
+                index.append(b'%d:%d:Page %d\n' % (offset, j, j))
+            offset += len(stream)
+        with open(self.index_path, 'wb') as f:
+            f.write(bz2.compress(b''.join(index)))
+
+    def read_all_pages(self, chunk_size):
+        pages = []
+        with open(self.path, 'rb') as f:
+            for start, end in dumps.split_multistream(self.path, chunk_size):
+                data = dumps.read_multistream_range(
+                    f, start, end, read_size = 7)
+                pages.extend(dumps.iter_pages(data, read_size = 11))
+        return pages
+
+    def test_read_pages(self):
+        pages = self.read_all_pages(os.path.getsize(self.path))
+        self.assertEqual([p[0] for p in pages], map(unicode, range(1, 31)))
+        self.assertEqual(
+            pages[0], ('1', 'Page 1', 'Text of page 1 & more', 1001))
+
+    def test_any_chunk_size(self):
+        expected = self.read_all_pages(os.path.getsize(self.path))
+        for chunk_size in [1, 5, 10, 64, 100, 1000]:
+            self.assertEqual(self.read_all_pages(chunk_size), expected)
+
+    def read_pages_with_index(self, pageids, chunk_size):
+        ranges = dumps.read_multistream_index(
+            self.path, self.index_path, pageids, chunk_size)
+        pages = []
+        with open(self.path, 'rb') as f:
+            for start, end in ranges:
+                data = dumps.read_multistream_range(f, start, end)
+                pages.extend(dumps.iter_pages(data))
+        return ranges, pages
+
+    def test_index(self):
+        ranges, pages = self.read_pages_with_index(set(['2', '8', '9']), 1)
+        self.assertEqual(len(ranges), 2)
+        self.assertEqual(
+            [p[0] for p in pages], ['1', '2', '3', '7', '8', '9'])
+
+        ranges, pages = self.read_pages_with_index(set(['2', '5']), 1000)
+        self.assertEqual(len(ranges), 1)
+        self.assertEqual(
+            [p[0] for p in pages], ['1', '2', '3', '4', '5', '6'])
+
+        # The last stream is read until the end of the dump
+        ranges, pages = self.read_pages_with_index(set(['30']), 1000)
+        self.assertEqual(ranges[0][1], os.path.getsize(self.path))
+        self.assertEqual([p[0] for p in pages], ['28', '29', '30'])
+
+        self.assertEqual(self.read_pages_with_index(set(['100']), 1), ([], []))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,8 @@ from common import *
 
 from snippet_parser import CITATION_NEEDED_MARKER, REF_MARKER
 
+import MySQLdb
+
 import collections
 import datetime
 import urllib
@@ -19,6 +21,10 @@ CITATION_NEEDED_MARKUP = flask.Markup(SUPERSCRIPT_HTML)
 Category = collections.namedtuple('Category', ['id', 'title'])
 CATEGORY_ALL = Category('all', '')
 
+# The languages whose database no longer has the snippets_links table, so
+# query_next_id doesn't keep falling back to it
+_langs_without_snippets_links = set()
+
 # A class wrapping database access functions so they're easier to
 # mock when testing.
 class Database(object):
@@ -64,10 +70,36 @@ class Database(object):
         cursor = get_db(lang_code).cursor()
 
         with log_time('select next id'):
-            cursor.execute('''
-                SELECT next FROM snippets_links WHERE prev = %s
-                AND cat_id = %s''', (curr_id, cat_id))
-            return cursor.fetchone()
+            try:
+                cursor.execute('''
+                    SELECT next_pos.snippet_id
+                    FROM category_sizes, snippets_positions AS curr_pos,
+                    snippets_positions AS next_pos
+                    WHERE category_sizes.cat_id = %s AND
+                    curr_pos.cat_num = category_sizes.cat_num AND
+                    curr_pos.snippet_id = %s AND
+                    next_pos.cat_num = category_sizes.cat_num AND
+                    next_pos.pos = MOD(curr_pos.pos + 1, category_sizes.size)
+                    ''', (cat_id, curr_id))
+                ret = cursor.fetchone()
+            except MySQLdb.ProgrammingError:
+                # The tables don't exist yet
+                ret = None
+            if ret is not None or lang_code in _langs_without_snippets_links:
+                return ret
+
+            # FIXME: Databases built before snippets_positions only have
+            # snippets_links. Remove this once they have all been rebuilt.
+            try:
+                cursor.execute('''
+                    SELECT next FROM snippets_links WHERE prev = %s
+                    AND cat_id = %s''', (curr_id, cat_id))
+                return cursor.fetchone()
+            except MySQLdb.ProgrammingError:
+                # It's dropped when installing a rebuilt database, and
+                # doesn't come back
+                _langs_without_snippets_links.add(lang_code)
+                return None
 
     @staticmethod
     def search_category(lang_code, needle, max_results):
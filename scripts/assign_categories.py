@@ -3,11 +3,18 @@
 '''
 Assign categories to the pages in the CitationHunt database.
 
+The categories are normally read from the Wikipedia database, but can also be
+read from the page.sql.gz and categorylinks.sql.gz dumps.
+
 Usage:
     assign_categories.py [--mysql_config=<FILE>]
+    assign_categories.py --page-dump=<FILE> --categorylinks-dump=<FILE>
+        [--mysql_config=<FILE>]
 
 Options:
-    --mysql_config=<FILE>  MySQL config file [default: ./ch.my.cnf].
+    --mysql_config=<FILE>        MySQL config file [default: ./ch.my.cnf].
+    --page-dump=<FILE>           The page.sql.gz dump.
+    --categorylinks-dump=<FILE>  The categorylinks.sql.gz dump.
 '''
 
 from __future__ import unicode_literals
@@ -21,10 +28,12 @@ if _upper_dir not in sys.path:
 
 import config
 import chdb as chdb_
+import dumps
 from utils import *
 
 import docopt
 
+import contextlib
 import cProfile
 import itertools as it
 import re
@@ -41,6 +50,12 @@ def ichunk(iterable, chunk_size):
         next(it2)  # raises StopIteration if it0 is exhausted
         yield it1
 
+@contextlib.contextmanager
+def timed(phase):
+    start = time.time()
+    yield
+    log.info('%s took %.1f seconds.' % (phase, time.time() - start))
+
 class CategoryName(unicode):
     '''
     The canonical format for categories, which is the one we'll use
@@ -77,9 +92,10 @@ class CategoryName(unicode):
 
 def category_ids_to_names(wpcursor, category_ids):
     category_names = set()
-    for pageid in category_ids:
-        wpcursor.execute('''SELECT page_title FROM page WHERE page_id = %s''',
-            (pageid,))
+    for chunk, in_page_ids in chdb_.in_chunks(category_ids):
+        wpcursor.execute(
+            '''SELECT page_title FROM page WHERE page_id IN %s''' %
+            in_page_ids, chunk)
         category_names.update(
             CategoryName.from_wp_page(row[0])
             for row in wpcursor)
@@ -100,20 +116,57 @@ def load_hidden_categories(wpcursor, cfg):
     hidden_page_ids = [row[0] for row in wpcursor]
     return category_ids_to_names(wpcursor, hidden_page_ids)
 
-def load_categories_for_pages(wpcursor, pageids):
+def load_categories_for_pages(wpcursor, pageids, in_pageids):
     wpcursor.execute('''
-        SELECT cl_to, cl_from FROM categorylinks WHERE cl_from IN %s''',
-        (tuple(pageids),))
-    return ((CategoryName.from_wp_categorylinks(row[0]), row[1])
-            for row in wpcursor)
+        SELECT cl_to, cl_from FROM categorylinks WHERE cl_from IN %s''' %
+        in_pageids, pageids)
+    return [(CategoryName.from_wp_categorylinks(row[0]), row[1])
+            for row in wpcursor]
+
+def load_categories_from_dumps(
+    cfg, page_dump, categorylinks_dump, pageids):
+    '''Returns the hidden categories and the (category, page id) pairs for
+    `pageids`, like load_hidden_categories and load_categories_for_pages, but
+    reading the SQL dumps instead of the Wikipedia database.
+    '''
 
-def count_snippets_for_pages(chcursor):
-    chcursor.execute(
-        '''SELECT article_id, count(snippets.id) '''
-        '''FROM snippets GROUP BY article_id''')
-    return {row[0]: row[1] for row in chcursor}
+    hidden_category = e(cfg.hidden_category)
+    hidden_page_ids = set()
+    categories_for_pages = []
+    # A single pass over categorylinks for both
+    for cl_from, cl_to in dumps.iter_sql_dump_rows(
+        categorylinks_dump, ['cl_from', 'cl_to']):
+        if cl_to == hidden_category:
+            hidden_page_ids.add(cl_from)
+        if cl_from in pageids:
+            categories_for_pages.append(
+                (CategoryName.from_wp_categorylinks(cl_to), cl_from))
+
+    hidden_categories = set(
+        CategoryName.from_wp_page(title)
+        for title in dumps.load_page_titles(
+            page_dump, dumps.CATEGORY_NAMESPACE, hidden_page_ids).values())
+    return hidden_categories, categories_for_pages
+
+def load_snippets_by_page(chcursor):
+    '''Returns a dict of page id -> (rank, [snippet ids]), where the rank of
+    a page is its position when sorted by title.
+
+    The titles are sorted by the database, so the order follows the
+    collation of the articles table rather than Python's.
+    '''
 
-def load_projectindex(cfg):
+    chcursor.execute('''
+        SELECT articles.page_id, snippets.id
+        FROM articles, snippets WHERE snippets.article_id = articles.page_id
+        ORDER BY articles.title, articles.page_id, snippets.id''')
+    page_id_to_snippets = {}
+    for page_id, snippet_id in chcursor:
+        page_id_to_snippets.setdefault(
+            page_id, (len(page_id_to_snippets), []))[1].append(snippet_id)
+    return page_id_to_snippets
+
+def load_projectindex(cfg, pageids):
     if not running_in_tools_labs() or cfg.lang_code != 'en':
         return []
     tldb = chdb_.init_projectindex_db()
@@ -127,13 +180,16 @@ def load_projectindex(cfg):
     FROM enwiki_index
     JOIN enwiki_page ON index_page = page_id
     JOIN enwiki_project ON index_project = project_id
-    WHERE page_ns = 0 AND page_is_redirect = 0
+    WHERE page_ns = 0 AND page_is_redirect = 0 AND page_id IN %s
     """
-    tlcursor.execute(query)
-
-    ret = [(CategoryName.from_tl_projectindex(r[0]), r[1]) for r in tlcursor]
+    ret = []
+    for chunk, in_pageids in chdb_.in_chunks(sorted(pageids)):
+        tlcursor.execute(query % in_pageids, chunk)
+        ret.extend(
+            (CategoryName.from_tl_projectindex(r[0]), r[1]) for r in tlcursor)
+    tldb.close()
     log.info('loaded %d entries from projectinfo (%s...)' % \
-        (len(ret), ret[0][0]))
+        (len(ret), ret[0][0] if ret else ''))
     return ret
 
 def category_is_usable(cfg, catname, hidden_categories):
@@ -145,45 +201,27 @@ def category_is_usable(cfg, catname, hidden_categories):
             return False
     return True
 
-def build_snippets_links_for_category(cursor, category_ids):
-    def pair_with_next(iterator):
-        """
-        Given an iterator (..., x, y, z, w, ...), returns another iterator of
-        tuples that pair each element to its successor, that is
-        (..., (x, y), (y, z), (z, w), ...).
-
-        The iterator "wraps around" at the end, that is, the last element is
-        paired with the first.
-        """
-
-        i1, i2 = it.tee(iterator)
-        return it.izip(i1, it.chain(i2, [next(i2)]))
-
-    # Populate the snippets_links table with pairs of snippets in the same
-    # category, so each article "points" to the next one in that category.
-    # The snippets are sorted by the title of their corresponding article.
-
-    # First, query all categories and snippets, in the proper order
-    cursor.execute('''
-        SELECT articles_categories.category_id, snippets.id
-        FROM snippets, articles_categories, articles
-        WHERE snippets.article_id = articles_categories.article_id AND
-        articles.page_id = articles_categories.article_id AND
-        articles_categories.category_id IN %s
-        ORDER BY articles_categories.category_id, articles.title;''',
-        (tuple(category_ids),))
-
-    # Now we indulge in some itertools magic to produce the pairs (or rather,
-    # triplets, as they also include the category id) that we want to insert.
-    # We want to use executemany for performance; the use of iterators saves
-    # some memory, but really I just wanted to look cool.
-    cursor.executemany('''
-        INSERT INTO snippets_links VALUES (%s, %s, %s)
-    ''', ((p, n, category_id)
-        for category_id, group in it.groupby(cursor, lambda (cid, sid): cid)
-        for p, n in pair_with_next(snippet_id for (_, snippet_id) in group)))
-
-def update_citationhunt_db(chdb, category_name_id_and_page_ids):
+def iter_category_snippets(category_name_id_and_page_ids, page_id_to_snippets):
+    # Each category's snippets are sorted by the title of their corresponding
+    # article, using the ranks from load_snippets_by_page, so there's no need
+    # to join and sort in the database for every category. The "next" snippet
+    # after each one is the snippet in the following position, wrapping
+    # around at the end (see Database.query_next_id).
+    for _, category_id, page_ids in category_name_id_and_page_ids:
+        ranks_and_snippet_ids = sorted(
+            page_id_to_snippets[p] for p in set(page_ids)
+            if p in page_id_to_snippets)
+        yield category_id, [snippet_id
+            for _, snippet_ids in ranks_and_snippet_ids
+            for snippet_id in snippet_ids]
+
+def iter_snippets_positions(category_snippets):
+    for cat_num, (_, snippet_ids) in category_snippets:
+        for pos, snippet_id in enumerate(snippet_ids):
+            yield (cat_num, pos, snippet_id)
+
+def update_citationhunt_db(
+    chdb, category_name_id_and_page_ids, page_id_to_snippets):
     def insert(cursor, chunk):
         cursor.executemany('''
             INSERT IGNORE INTO categories VALUES (%s, %s)
@@ -193,12 +231,31 @@ def update_citationhunt_db(chdb, category_name_id_and_page_ids):
             INSERT INTO articles_categories VALUES (%s, %s)
         ''', ((pageid, catid)
             for _, catid, pageids in chunk for pageid in pageids))
-        build_snippets_links_for_category(cursor,
-            (cid for (_, cid, _) in chunk))
+
+    def insert_category_sizes(cursor, chunk):
+        cursor.executemany('''
+            INSERT INTO category_sizes VALUES (%s, %s, %s)
+        ''', [(category_id, cat_num, len(snippet_ids))
+            for cat_num, (category_id, snippet_ids) in chunk])
+
+    def insert_snippets_positions(cursor, rows):
+        cursor.executemany('''
+            INSERT INTO snippets_positions VALUES (%s, %s, %s)
+        ''', rows)
 
     for c in ichunk(category_name_id_and_page_ids, 4096):
         chdb.execute_with_retry(insert, list(c))
 
+    # One transaction per chunk, each a multi-row INSERT small enough to fit
+    # in a packet
+    category_snippets = list(enumerate(iter_category_snippets(
+        category_name_id_and_page_ids, page_id_to_snippets)))
+    for chunk in ichunk(category_snippets, chdb_.IN_CHUNK_SIZE):
+        chdb.execute_with_retry(insert_category_sizes, list(chunk))
+    for rows in ichunk(iter_snippets_positions(category_snippets),
+                       chdb_.IN_CHUNK_SIZE):
+        chdb.execute_with_retry(insert_snippets_positions, list(rows))
+
     chdb.execute_with_retry_s('''
         INSERT INTO category_article_count
         SELECT category_id, COUNT(*) AS article_count
@@ -207,12 +264,19 @@ def update_citationhunt_db(chdb, category_name_id_and_page_ids):
 def reset_chdb_tables(cursor):
     log.info('resetting articles_categories table...')
     cursor.execute('DELETE FROM articles_categories')
+    # The scratch tables may not have foreign keys yet, so don't rely on
+    # deleting the categories to cascade to the tables that reference them
+    log.info('resetting category_article_count table...')
+    cursor.execute('DELETE FROM category_article_count')
     log.info('resetting categories table...')
     cursor.execute('DELETE FROM categories')
-    log.info('resetting snippets_links table...')
-    cursor.execute('DELETE FROM snippets_links')
+    log.info('resetting snippets_positions table...')
+    cursor.execute('DELETE FROM snippets_positions')
+    log.info('resetting category_sizes table...')
+    cursor.execute('DELETE FROM category_sizes')
 
-def assign_categories(mysql_default_cnf):
+def assign_categories(
+    mysql_default_cnf, page_dump = None, categorylinks_dump = None):
     cfg = config.get_localized_config()
     profiler = cProfile.Profile()
     if cfg.profile:
@@ -220,39 +284,51 @@ def assign_categories(mysql_default_cnf):
     start = time.time()
 
     chdb = chdb_.init_scratch_db()
-    wpdb = chdb_.init_wp_replica_db()
+    wpdb = chdb_.init_wp_replica_db() if page_dump is None else None
 
-    chdb.execute_with_retry(reset_chdb_tables)
+    with timed('resetting tables'):
+        chdb.execute_with_retry(reset_chdb_tables)
     unsourced_pageids = load_unsourced_pageids(chdb)
 
-    # Load a list of (wikiproject, page ids), if applicable
-    # FIXME: We load all category -> page id mappings for all projects, then
-    # filter out the ones with no unsourced snippets. It's likely better to just
-    # query the projects of the pages we know of instead.
-    projectindex = load_projectindex(cfg)
-
-    # Load a set() of hidden categories
-    hidden_categories = wpdb.execute_with_retry(
-        load_hidden_categories, cfg)
+    # Load a list of (wikiproject, page ids) for the pages we know of, if
+    # applicable
+    with timed('loading projectindex'):
+        projectindex = load_projectindex(cfg, unsourced_pageids)
+
+    # Load a set() of hidden categories, and the (category, page id) pairs
+    # for the pages we know of
+    with timed('loading categories'):
+        if wpdb is not None:
+            hidden_categories = wpdb.execute_with_retry(
+                load_hidden_categories, cfg)
+            categories_for_pages = [
+                (c, p) for chunk, in_pageids in chdb_.in_chunks(
+                    sorted(unsourced_pageids), 10000)
+                for c, p in wpdb.execute_with_retry(
+                    load_categories_for_pages, chunk, in_pageids)]
+        else:
+            hidden_categories, categories_for_pages = \
+                load_categories_from_dumps(
+                    cfg, page_dump, categorylinks_dump, unsourced_pageids)
     log.info('loaded %d hidden categories (%s...)' % \
         (len(hidden_categories), next(iter(hidden_categories))))
 
     # Load all usable categories into a dict category -> [page ids]
     category_to_page_ids = {}
     for c, p in projectindex:
-        if p in unsourced_pageids:
+        category_to_page_ids.setdefault(c, []).append(p)
+    for c, p in categories_for_pages:
+        if category_is_usable(cfg, c, hidden_categories):
             category_to_page_ids.setdefault(c, []).append(p)
-    for c in ichunk(unsourced_pageids, 10000):
-        for c, p in wpdb.execute_with_retry(load_categories_for_pages, c):
-            if category_is_usable(cfg, c, hidden_categories):
-                category_to_page_ids.setdefault(c, []).append(p)
 
     # Now find out how many snippets each category has
     category_to_snippet_count = {}
-    page_id_to_snippet_count = chdb.execute_with_retry(count_snippets_for_pages)
+    with timed('loading snippets'):
+        page_id_to_snippets = chdb.execute_with_retry(load_snippets_by_page)
     for category, page_ids in category_to_page_ids.iteritems():
         category_to_snippet_count[category] = sum(
-            page_id_to_snippet_count.get(p, 0) for p in page_ids)
+            len(page_id_to_snippets[p][1]) for p in page_ids
+            if p in page_id_to_snippets)
 
     # And keep only the ones with at least two.
     category_name_id_and_page_ids = [
@@ -262,8 +338,11 @@ def assign_categories(mysql_default_cnf):
     ]
     log.info('finished with %d categories' % len(category_name_id_and_page_ids))
 
-    update_citationhunt_db(chdb, category_name_id_and_page_ids)
-    wpdb.close()
+    with timed('updating the database'):
+        update_citationhunt_db(
+            chdb, category_name_id_and_page_ids, page_id_to_snippets)
+    if wpdb is not None:
+        wpdb.close()
     chdb.close()
     log.info('all done in %d seconds.' % (time.time() - start))
 
@@ -276,5 +355,6 @@ def assign_categories(mysql_default_cnf):
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
     mysql_default_cnf = args['--mysql_config']
-    ret = assign_categories(mysql_default_cnf)
+    ret = assign_categories(mysql_default_cnf,
+        args['--page-dump'], args['--categorylinks-dump'])
     sys.exit(ret)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+'''
+Benchmark the traversal of the citation needed category tree used by
+print_unsourced_pageids_from_wikipedia.py, against a SQLite stand-in for the
+categorylinks and page tables.
+
+A synthetic category tree is generated, in which each category has the given
+number of subcategories and pages, down to the given depth. As on Wikipedia,
+some pages are in more than one category and the deepest categories link back
+to the root, so the category graph has cycles. The tree is then traversed
+looking up the given number of categories per query, and the time and number
+of queries for each are reported.
+
+Usage:
+    benchmark_category_traversal.py [--depth=<n>] [--subcategories=<n>] [--pages=<n>] [--chunk-sizes=<list>]
+
+Options:
+    --depth=<n>             Levels of subcategories [default: 4].
+    --subcategories=<n>     Subcategories per category [default: 8].
+    --pages=<n>             Pages per category [default: 50].
+    --chunk-sizes=<list>    Comma-separated chunk sizes [default: 1,100,1000].
+'''
+
+from __future__ import unicode_literals
+
+import os
+import sys
+_upper_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+if _upper_dir not in sys.path:
+    sys.path.append(_upper_dir)
+
+import print_unsourced_pageids_from_wikipedia as unsourced
+from utils import *
+
+import docopt
+
+import random
+import sqlite3
+import time
+
+log = Logger()
+
+ROOT_CATEGORY = 'All_articles_with_unsourced_statements'
+
+class SQLiteCursor(object):
+    '''Wraps a sqlite3 cursor to take MySQLdb's %s placeholders, and counts
+    the queries made.'''
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.queries = 0
+
+    def execute(self, sql, args = ()):
+        self.queries += 1
+        return self._cursor.execute(sql.replace('%s', '?'), list(args))
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+def create_category_tree(db, depth, nsubcategories, npages):
+    '''Fills in the categorylinks and page tables with a category tree, and
+    returns how many distinct pages it has.'''
+
+    db.execute('''
+        CREATE TABLE page (page_id INTEGER PRIMARY KEY, page_title TEXT)''')
+    db.execute('''
+        CREATE TABLE categorylinks (cl_from INTEGER, cl_to TEXT,
+        cl_type TEXT)''')
+
+    categories = [(1, ROOT_CATEGORY)]
+    level = list(categories)
+    for _ in range(depth):
+        next_level = []
+        for _ in level:
+            for _ in range(nsubcategories):
+                page_id = len(categories) + 1
+                category = (page_id, 'Category_%d' % page_id)
+                categories.append(category)
+                next_level.append(category)
+        level = next_level
+    # The deepest categories link back to the root
+    subcategory_links = [(1, title, 'subcat') for _, title in level]
+    for i, (page_id, title) in enumerate(categories[1:]):
+        _, parent = categories[i // nsubcategories]
+        subcategory_links.append((page_id, parent, 'subcat'))
+
+    # Draw the pages from a pool smaller than the number of memberships, so
+    # many pages are in more than one category
+    rng = random.Random(0)
+    first_page_id = len(categories) + 1
+    npool = len(categories) * npages // 2
+    page_links = set()
+    for _, title in categories:
+        for page_id in rng.sample(xrange(npool), npages):
+            page_links.add((first_page_id + page_id, title, 'page'))
+
+    db.executemany('INSERT INTO page VALUES (?, ?)', categories)
+    db.executemany('INSERT INTO categorylinks VALUES (?, ?, ?)',
+                   subcategory_links + list(page_links))
+    db.execute('''
+        CREATE INDEX cl_to_type ON categorylinks (cl_to, cl_type)''')
+    db.commit()
+    log.info('%d categories, %d category memberships' % (
+        len(categories), len(subcategory_links) + len(page_links)))
+    return len(set(page_id for page_id, _, _ in page_links))
+
+def benchmark_category_traversal(depth, nsubcategories, npages, chunk_sizes):
+    db = sqlite3.connect(':memory:')
+    expected_npages = create_category_tree(
+        db, depth, nsubcategories, npages)
+
+    ret = 0
+    for chunk_size in chunk_sizes:
+        cursor = SQLiteCursor(db.cursor())
+        limits = unsourced.CategoryLimits(None, None)
+        start = time.time()
+        page_ids = list(unsourced.iter_category_members(
+            cursor, ROOT_CATEGORY, limits, chunk_size))
+        elapsed = time.time() - start
+        log.info('chunks of %d: %d pages in %.2f seconds, %d queries' % (
+            chunk_size, len(page_ids), elapsed, cursor.queries))
+        if len(page_ids) != expected_npages or \
+            len(set(page_ids)) != len(page_ids):
+            log.info('expected %d distinct pages!' % expected_npages)
+            ret = 1
+    return ret
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    ret = benchmark_category_traversal(
+        int(args['--depth']), int(args['--subcategories']),
+        int(args['--pages']), map(int, args['--chunk-sizes'].split(',')))
+    sys.exit(ret)
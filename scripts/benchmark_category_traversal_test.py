@@ -0,0 +1,28 @@
+from __future__ import unicode_literals
+
+from benchmark_category_traversal import *
+
+import sqlite3
+import unittest
+
+class CategoryTraversalTest(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.addCleanup(self.db.close)
+
+    def test_traverse_category_tree(self):
+        npages = create_category_tree(self.db, 2, 2, 3)
+        self.assertEqual(self.db.execute(
+            "SELECT COUNT(*) FROM categorylinks WHERE cl_type = 'subcat'"
+            ).fetchone()[0], 6 + 4)
+
+        for chunk_size in (1, 100):
+            cursor = SQLiteCursor(self.db.cursor())
+            page_ids = list(unsourced.iter_category_members(
+                cursor, ROOT_CATEGORY, unsourced.CategoryLimits(None, None),
+                chunk_size))
+            self.assertEqual(len(page_ids), npages)
+            self.assertEqual(len(set(page_ids)), npages)
+
+if __name__ == '__main__':
+    unittest.main()
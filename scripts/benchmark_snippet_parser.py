@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+'''
+Benchmark the snippet parser on local wikitext files.
+
+Each file should contain the wikitext of a single article. The files are parsed
+with and without the snippet parser's fast path, and the throughput of both is
+reported. The snippets extracted in both cases are also compared, since the
+fast path should never change the output.
+
+By default, the parser doesn't go to the network at all, so snippets are not
+converted to HTML. With --replay, the API responses recorded in a previous run
+with wikipedia_api_mode = 'record' (see ../config.py) are used instead, so the
+conversion to HTML is benchmarked too, still without the network.
+
+Make sure to set the CH_LANG environment variable before invoking this script.
+
+Usage:
+    benchmark_snippet_parser.py <wikitext-file>... [--iterations=<n>] [--replay]
+
+Options:
+    --iterations=<n>    How many times to parse each file [default: 5].
+    --replay            Use the recorded API responses.
+'''
+
+from __future__ import unicode_literals
+
+import os
+import sys
+_upper_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+if _upper_dir not in sys.path:
+    sys.path.append(_upper_dir)
+
+import config
+import snippet_parser
+import wpapi
+from utils import *
+
+import docopt
+
+import copy
+import time
+
+log = Logger()
+
+def benchmark(parser, wikitexts, iterations):
+    snippets = []
+    start = time.time()
+    for i in range(iterations):
+        snippets = [parser.extract(wikitext) for wikitext in wikitexts]
+    return snippets, time.time() - start
+
+def benchmark_snippet_parser(wikitexts, iterations, replay = False):
+    cfg = config.get_localized_config()
+    wikipedia = None # so we don't go to the network
+    templates = None
+    if replay:
+        wikipedia = wpapi.create_wikipedia_api(cfg, wpapi.REPLAY)
+        templates = snippet_parser.load_citation_needed_templates(
+            wikipedia, cfg)
+        # Don't let the HTML cache hide the cost of converting to HTML
+        cfg.cache_dir = None
+    slow_cfg = copy.copy(cfg)
+    slow_cfg.snippet_parser_fast_path = False
+
+    results = []
+    for name, c in [('slow path', slow_cfg), ('fast path', cfg)]:
+        parser = snippet_parser.create_snippet_parser(wikipedia, c, templates)
+        snippets, elapsed = benchmark(parser, wikitexts, iterations)
+        log.info('%s: %d pages in %.2f seconds (%.1f pages/s)' % (
+            name, len(wikitexts) * iterations, elapsed,
+            len(wikitexts) * iterations / elapsed))
+        results.append((snippets, elapsed))
+
+    (slow_snippets, slow_elapsed), (fast_snippets, fast_elapsed) = results
+    if slow_snippets != fast_snippets:
+        log.info('the fast path changed the output!')
+        return 1
+    log.info('speedup: %.2fx' % (slow_elapsed / fast_elapsed))
+    return 0
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__)
+    wikitexts = []
+    for path in arguments['<wikitext-file>']:
+        with open(path) as f:
+            wikitexts.append(d(f.read()))
+    ret = benchmark_snippet_parser(
+        wikitexts, int(arguments['--iterations']), arguments['--replay'])
+    sys.exit(ret)
@@ -25,9 +25,9 @@ import config
 import chdb
 from utils import *
 import snippet_parser
+import wpapi
 
 import docopt
-import wikitools
 
 log = Logger()
 
@@ -79,20 +79,22 @@ def compute_fixed_snippets(cfg):
     log.info('Will reparse pages: %r' % page_title_to_snippets.keys())
 
     # Now fetch and parse the pages and check which snippets are gone
-    wiki = wikitools.wiki.Wiki(
-            'https://' + cfg.wikipedia_domain + '/w/api.php')
-    wiki.setUserAgent(
-            'citationhunt (https://tools.wmflabs.org/citationhunt)')
+    wiki = wpapi.create_wikipedia_api(cfg)
     parser = snippet_parser.create_snippet_parser(wiki, cfg)
 
     for page_title, snippet_to_ts in page_title_to_snippets.items():
-        page = wikitools.Page(wiki, page_title)
-        snippets = parser.extract(page.getWikiText())
+        page = wiki.get_page_by_title(page_title)
+        if page is None:
+            log.info('page %s no longer exists' % page_title)
+            continue
         # FIXME Duplicated logic with parse_live.py :(
-        for sec, snips in snippets:
-            for sni in snips:
-                id = mkid(d(page.title) + sni)
-                snippet_to_ts.pop(id, None)
+        _, title, wikitext, _ = page
+        for sec, sni in parser.iter_extract(wikitext,
+            lambda sec, sni: mkid(title + sni) in snippet_to_ts):
+            snippet_to_ts.pop(mkid(title + sni))
+            if not snippet_to_ts:
+                # All snippets are still there, no need to parse further
+                break
 
         for snippet_id, clicked_ts in snippet_to_ts.items():
             log.info(snippet_id)
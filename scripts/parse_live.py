@@ -8,11 +8,52 @@ snippets in the pages in the pageid file. It will store the pages containing
 valid snippets in the `articles` database table, and the snippets in the
 `snippets` table.
 
+The pages are normally retrieved from the Wikipedia API. Alternatively, they
+can be read from a local pages-articles-multistream.xml.bz2 dump, which doesn't
+need to download the pages and is reproducible. If the dump's
+multistream-index.txt.bz2 file is also given, only the parts of the dump
+containing the pages in the pageid file are read.
+
+Pages that are too large or take too long to parse, as configured in
+config.py, are skipped and listed in a report in the log directory. They can
+optionally be retried without limits at the end of the run, unless reading
+from a dump.
+
+The pages that are done are recorded in the scratch database along with their
+snippets, so a run that timed out or crashed can be continued with --resume,
+which starts over if there is no such run. On timeout, the pages that are
+already being parsed are still written for a little while before giving up.
+
+Normally, all pageids are read upfront, so the largest pages can be parsed
+first. For very large pageid files, the pageids can instead be read as they
+are needed with --stream, which uses the same amount of memory however many
+pages there are.
+
+With --incremental, pages whose latest revision is the same as the one in
+the live database are copied over from it rather than fetched and parsed
+again. Only do this if the snippet parser hasn't changed since then!
+
+With --delta, the pageid file is a delta file written by
+print_unsourced_pageids_from_wikipedia.py. Only the added pages are parsed,
+and the unchanged ones are copied over from the live database. The removed
+pages are left out, along with their snippets and categories, so they're
+deleted when the new database is installed. With --incremental too, the
+unchanged pages are also parsed again if they were edited. If the live
+database predates revision ids, all pages are parsed.
+
 Usage:
-    parse_live.py <pageid-file> [--timeout=<n>]
+    parse_live.py <pageid-file> [--timeout=<n>] [--resume] [--stream]
+    parse_live.py <pageid-file> [--timeout=<n>] [--resume] [--incremental] [--delta]
+    parse_live.py <pageid-file> --dump=<file> [--dump-index=<file>] [--timeout=<n>] [--resume] [--delta]
 
 Options:
-    --timeout=<n>    Maximum time in seconds to run for [default: inf].
+    --timeout=<n>          Maximum time in seconds to run for [default: inf].
+    --resume               Continue a previous run instead of starting over.
+    --stream               Read the pageids as they are needed.
+    --incremental          Only parse pages that changed since the last run.
+    --delta                The pageid file is a delta against the last run.
+    --dump=<file>          Read the pages from a multistream XML dump.
+    --dump-index=<file>    The multistream index file for the dump.
 '''
 
 from __future__ import unicode_literals
@@ -26,22 +67,27 @@ if _upper_dir not in sys.path:
 
 import chdb
 import config
+import dumps
 import snippet_parser
 import multiprocessing
+import multiprocessing.pool
+import wpapi
 from utils import *
 
 import docopt
-import requests
-import wikitools
 
-import StringIO
+import Queue
 import cProfile
 import functools
 import glob
+import hashlib
 import itertools
 import pstats
+import resource
 import shutil
+import signal
 import tempfile
+import threading
 import time
 import traceback
 import urllib
@@ -49,10 +95,13 @@ import urllib
 cfg = config.get_localized_config()
 WIKIPEDIA_BASE_URL = 'https://' + cfg.wikipedia_domain
 WIKIPEDIA_WIKI_URL = WIKIPEDIA_BASE_URL + '/wiki/'
-WIKIPEDIA_API_URL = WIKIPEDIA_BASE_URL + '/w/api.php'
 
 MAX_EXCEPTIONS_PER_SUBPROCESS = 5
 
+# How many bytes of a dump each task reads. Multistream dumps have about 100
+# pages per bzip2 stream, and each stream is a few hundred kilobytes.
+DUMP_CHUNK_SIZE = 16 * 1024 * 1024
+
 log = Logger()
 
 def section_name_to_anchor(section):
@@ -66,67 +115,46 @@ def section_name_to_anchor(section):
     section = section.replace('%', '.')
     return section
 
-def query_pageids(wiki, pageids):
-    params = {
-        'action': 'query',
-        'pageids': '|'.join(map(str, pageids)),
-        'prop': 'revisions',
-        'rvprop': 'content'
-    }
-
-    request = wikitools.APIRequest(wiki, params)
-    for response in request.queryGen():
-        for id, page in response['query']['pages'].items():
-            if 'title' not in page:
-                continue
-            title = d(page['title'])
-
-            text = page['revisions'][0]['*']
-            if not text:
-                continue
-            text = d(text)
-            yield (id, title, text)
-
-# An adapter that lets us use requests for wikitools until it doesn't grow
-# native support. This allows us to have persistent connections.
-class WikitoolsRequestsAdapter(object):
-    def __init__(self):
-        self.session = requests.Session()
-
-    def open(self, request):
-        headers = dict(request.headers)
-        headers.pop('Content-length') # Let requests compute this
-        response = self.session.get(
-            request.get_full_url() + '?' + request.get_data(),
-            headers = headers)
-        return urllib.addinfourl(
-            StringIO.StringIO(response.text), request.headers,
-            request.get_full_url(), response.status_code)
+# Not an Exception, so code that catches all exceptions while a page is being
+# parsed doesn't swallow it
+class PageBudgetExceeded(BaseException):
+    pass
+
+def on_page_budget_exceeded(signum, frame):
+    # The timer can go off just as it's being turned off, after the page is
+    # done
+    if self.in_page_budget:
+        raise PageBudgetExceeded()
 
 # In py3: types.SimpleNamespace
 class State(object):
     pass
 self = State() # Per-process state
+self.exception_count = 0
+self.in_page_budget = False
 
-def initializer(backdir):
+class FetchState(threading.local):
+    '''Per-thread state of the fetch threads in the main process, so each
+    of them gets its own exception budget, like a worker process.'''
+
+    def __init__(self):
+        self.exception_count = 0
+fetch_state = FetchState()
+
+def initializer(backdir, citation_needed_templates, pageids, dump):
     self.backdir = backdir
+    self.pageids = pageids
+    self.dump = dump
 
-    # Monkey-patch wikitools to always use our existing session
-    opener = WikitoolsRequestsAdapter()
-    APIRequest = wikitools.api.APIRequest
-    class RequestsAPIRequest(wikitools.api.APIRequest):
-        def __init__(self, *args, **kwds):
-            APIRequest.__init__(self, *args, **kwds)
-            self.opener = opener
-    wikitools.APIRequest = RequestsAPIRequest
-    wikitools.api.APIRequest = RequestsAPIRequest
-
-    self.wiki = wikitools.wiki.Wiki(WIKIPEDIA_API_URL)
-    self.wiki.setUserAgent(
-        'citationhunt (https://tools.wmflabs.org/citationhunt)')
-    self.parser = snippet_parser.create_snippet_parser(self.wiki, cfg)
-    self.chdb = chdb.init_scratch_db()
+    # The snippet parser may still go to the API
+    self.api = wpapi.create_wikipedia_api(cfg)
+    self.parser = snippet_parser.create_snippet_parser(
+        self.api, cfg, citation_needed_templates)
     self.exception_count = 0
+    self.tasks_done = 0
+
+    # ITIMER_PROF counts the CPU time used by this process
+    signal.signal(signal.SIGPROF, on_page_budget_exceeded)
 
     if cfg.profile:
         self.profiler = cProfile.Profile()
@@ -139,74 +167,614 @@ def finalizer():
     profile_path = os.path.join(self.backdir, 'profile-%s' % os.getpid())
     pstats.Stats(self.profiler).dump_stats(profile_path)
 
-def with_max_exceptions(fn):
+def peak_rss_bytes():
+    # In kilobytes on Linux, but bytes on OS X
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def write_memory_report():
+    memory_path = os.path.join(self.backdir, 'memory-%s' % os.getpid())
+    with open(memory_path, 'w') as f:
+        print >>f, '%d\t%d' % (peak_rss_bytes(), self.tasks_done)
+
+def load_memory_report(backdir):
+    report = {}
+    for memory_path in glob.glob(os.path.join(backdir, 'memory-*')):
+        pid = memory_path.rsplit('-', 1)[1]
+        with open(memory_path) as f:
+            report[pid] = map(int, f.read().split())
+    return report
+
+def log_memory_report(report, max_workers = 10):
+    if not report:
+        return
+    # The workers that used the most memory
+    for pid, (peak_rss, tasks) in sorted(
+        report.items(), key = lambda (pid, r): r[0],
+        reverse = True)[:max_workers]:
+        log.info('worker %s: peak RSS %d MB after %d tasks' % (
+            pid, peak_rss / 1024**2, tasks))
+    log.info('%d workers, peak RSS %d MB' % (
+        len(report), max(r[0] for r in report.values()) / 1024**2))
+
+def worker_task(fn):
     @functools.wraps(fn)
     def wrapper(*args, **kwds):
         try:
             return fn(*args, **kwds)
-        except:
-            traceback.print_exc()
-            self.exception_count += 1
-            if self.exception_count > MAX_EXCEPTIONS_PER_SUBPROCESS:
-                raise
+        finally:
+            self.tasks_done += 1
+            write_memory_report()
     return wrapper
 
-@with_max_exceptions
-def work(pageids):
+def with_max_exceptions(state):
+    '''Swallows the exceptions of the decorated function, returning None,
+    until `state` has seen more than MAX_EXCEPTIONS_PER_SUBPROCESS.'''
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwds):
+            try:
+                return fn(*args, **kwds)
+            except Exception:
+                traceback.print_exc()
+                state.exception_count += 1
+                if state.exception_count > MAX_EXCEPTIONS_PER_SUBPROCESS:
+                    raise
+        return wrapper
+    return decorator
+
+def skip_page(pageid, title, reason):
+    log.info('skipping %s (%s): %s' % (title, pageid, reason))
+    skipped_path = os.path.join(self.backdir, 'skipped-%s' % os.getpid())
+    with open(skipped_path, 'a') as f:
+        print >>f, e('\t'.join((pageid, title, reason)))
+
+def extract_snippets_rows(pageid, title, wikitext):
+    snippets_rows = []
+    for sec, sni in self.parser.iter_extract(wikitext):
+        id = mkid(title + sni)
+        row = (id, sni, section_name_to_anchor(sec), pageid)
+        snippets_rows.append(row)
+    return snippets_rows
+
+def parse_pages(pages, enforce_budget = True):
+    '''Returns the rows for `pages` and the pageids of the pages that were
+    skipped.'''
+
     rows = []
-    results = query_pageids(self.wiki, pageids)
-    for pageid, title, wikitext in results:
+    skipped = set()
+    for pageid, title, wikitext, rev_id in pages:
         url = WIKIPEDIA_WIKI_URL + title.replace(' ', '_')
 
-        snippets_rows = []
-        snippets = self.parser.extract(wikitext)
-        for sec, snips in snippets:
-            sec = section_name_to_anchor(sec)
-            for sni in snips:
-                id = mkid(title + sni)
-                row = (id, sni, sec, pageid)
-                snippets_rows.append(row)
+        if enforce_budget and len(wikitext) > cfg.parse_live_max_page_size:
+            skip_page(pageid, title, 'size')
+            skipped.add(pageid)
+            continue
+        try:
+            if enforce_budget:
+                self.in_page_budget = True
+                signal.setitimer(
+                    signal.ITIMER_PROF, cfg.parse_live_max_page_cpu_seconds)
+            try:
+                snippets_rows = extract_snippets_rows(pageid, title, wikitext)
+            finally:
+                # Still inside the try below, in case the timer goes off
+                # before it's turned off
+                self.in_page_budget = False
+                signal.setitimer(signal.ITIMER_PROF, 0)
+        except PageBudgetExceeded:
+            skip_page(pageid, title, 'cpu')
+            skipped.add(pageid)
+            continue
 
         if snippets_rows:
-            article_row = (pageid, url, title)
+            article_row = (pageid, url, title, rev_id,
+                hashlib.sha1(e(wikitext)).hexdigest())
             rows.append({'article': article_row, 'snippets': snippets_rows})
+    return rows, skipped
+
+# The stages of the pipeline. Pages are fetched from the API by threads in the
+# main process, parsed in the process pool, and the resulting rows are written
+# to the database by another thread in the main process. The workers return
+# the pageids they are done with, which are checkpointed along with the rows.
+
+@with_max_exceptions(fetch_state)
+def fetch_pages(pageids, lengths = None):
+    pages, missing = self.api.get_pages(pageids, lengths)
+    if missing:
+        log.info('could not fetch pages %s' % ', '.join(missing))
+    return pages
+
+@worker_task
+@with_max_exceptions(self)
+def work(pageids, pages, enforce_budget = True):
+    rows, skipped = parse_pages(pages, enforce_budget)
+    return [p for p in pageids if p not in skipped], rows
+
+def work_without_budget(pageids, pages):
+    return work(pageids, pages, enforce_budget = False)
+
+@worker_task
+@with_max_exceptions(self)
+def work_dump(byte_range):
+    start, end = byte_range
+    with open(self.dump, 'rb') as f:
+        data = dumps.read_multistream_range(f, start, end)
+    pages = [page for page in dumps.iter_pages(data)
+             if page[0] in self.pageids]
+    rows, skipped = parse_pages(pages)
+    return [p[0] for p in pages if p[0] not in skipped], rows
+
+class RowsWriter(object):
+    '''Writes the rows produced by the workers to the scratch database.
+
+    Rows are buffered and inserted with multi-row INSERTs, one transaction
+    per `batch_size` snippets, which is a lot cheaper than a transaction per
+    article. The pageids that are done are checkpointed in the same
+    transaction as their rows.
+    '''
+
+    def __init__(self, db, batch_size):
+        self.db = db
+        self.batch_size = batch_size
+        self.pageids = []
+        self.articles = []
+        self.snippets = []
+        self.articles_written = 0
+        self.snippets_written = 0
+        self.start = time.time()
+
+    def add(self, pageids, rows):
+        self.pageids.extend(pageids)
+        for r in rows:
+            self.articles.append(r['article'])
+            self.snippets.extend(r['snippets'])
+        if len(self.snippets) >= self.batch_size or \
+            len(self.pageids) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        def insert(cursor, pageids, articles, snippets):
+            # MySQLdb turns these into a single multi-row INSERT each
+            if articles:
+                cursor.executemany('''
+                    INSERT IGNORE INTO articles VALUES(%s, %s, %s, %s, %s)''',
+                    articles)
+                cursor.executemany('''
+                    INSERT IGNORE INTO snippets VALUES(%s, %s, %s, %s)''',
+                    snippets)
+            cursor.executemany('''
+                INSERT IGNORE INTO parse_live_checkpoint VALUES(%s)''',
+                [(p,) for p in pageids])
+        if self.pageids:
+            self.db.execute_with_retry(
+                insert, self.pageids, self.articles, self.snippets)
+        self.articles_written += len(self.articles)
+        self.snippets_written += len(self.snippets)
+        self.pageids = []
+        self.articles = []
+        self.snippets = []
+        log.progress(self.stats())
+
+    def stats(self):
+        elapsed = max(time.time() - self.start, 1e-3)
+        return 'wrote %d articles and %d snippets (%.1f rows/s)' % (
+            self.articles_written, self.snippets_written,
+            (self.articles_written + self.snippets_written) / elapsed)
+
+def run_pipeline(tasks, submit, deadline):
+    '''Runs each task through the pipeline, where submit(task) fetches the
+    pages for the task, if needed, and submits them to the process pool.
+
+    Tasks are taken from the `tasks` iterable as they are needed and
+    submitted in order, and their rows are written in the order they finish,
+    so a slow task doesn't hold back the ones after it. At most
+    cfg.parse_live_max_pending_batches tasks wait to be parsed or written at
+    any time, so stages that get ahead of the others block. All rows are
+    written by a single thread, to avoid contention in the database.
+
+    After the deadline no more tasks are submitted, but the ones already
+    submitted are still written for up to cfg.parse_live_drain_seconds.
+    Returns 'done', 'timeout' or 'failed'.
+    '''
+
+    tasks = iter(tasks)
+    tasks_lock = threading.Lock()
+    # Fetchers take a slot before submitting a task, and the writer frees it
+    # once the task is written
+    slots = Queue.Queue(maxsize = cfg.parse_live_max_pending_batches)
+    submitted = Queue.Queue()
+    stop = threading.Event()
+    failed = threading.Event()
+    timed_out = threading.Event()
+
+    drain_deadline = deadline + cfg.parse_live_drain_seconds
+
+    def fetch():
+        while not stop.is_set() and not timed_out.is_set():
+            with tasks_lock:
+                task = next(tasks, None)
+            if task is None:
+                return
+            while not stop.is_set():
+                try:
+                    slots.put(None, timeout = 1)
+                    break
+                except Queue.Full:
+                    pass
+            else:
+                return
+            if timed_out.is_set():
+                # The deadline passed while waiting for the slot
+                slots.get_nowait()
+                return
+            submitted.put(submit(task))
+
+    def write():
+        writer = RowsWriter(
+            chdb.init_scratch_db(), cfg.parse_live_write_batch_size)
+        in_flight = []
+        all_submitted = False
+        while not stop.is_set():
+            try:
+                while True:
+                    result = submitted.get(block = not in_flight, timeout = 1)
+                    if result is None:
+                        all_submitted = True
+                        break
+                    else:
+                        in_flight.append(result)
+            except Queue.Empty:
+                pass
+            if all_submitted and not in_flight:
+                break
+            finished = [r for r in in_flight if r.ready()]
+            if not finished and in_flight:
+                in_flight[0].wait(0.05)
+            for result in finished:
+                in_flight.remove(result)
+                slots.get_nowait()
+                done = result.get() # raises if the worker gave up
+                if done:
+                    writer.add(*done)
+        writer.flush()
+        log.info(writer.stats())
+
+    def start_stage(target, nthreads):
+        def run():
+            try:
+                target()
+            except Exception:
+                traceback.print_exc()
+                failed.set()
+                stop.set()
+        threads = [threading.Thread(target = run) for _ in range(nthreads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def check_deadlines():
+        now = time.time()
+        if now > deadline and not timed_out.is_set():
+            log.info('timeout, writing the pages already being parsed')
+            timed_out.set()
+        if now > drain_deadline:
+            stop.set()
+
+    def wait_for(threads):
+        for thread in threads:
+            while thread.is_alive() and not stop.is_set():
+                check_deadlines()
+                thread.join(1)
+
+    fetchers = start_stage(fetch, cfg.parse_live_fetch_threads)
+    writers = start_stage(write, 1)
+    wait_for(fetchers)
+    submitted.put(None)
+    wait_for(writers)
+
+    # All threads notice we're stopping within a second or so, except for
+    # fetchers in the middle of a request, which we don't wait for as they're
+    # daemons anyway. The writer gets to flush the rows it has.
+    stop.set()
+    for thread in fetchers:
+        thread.join(2)
+    for thread in writers:
+        thread.join()
+
+    if failed.is_set():
+        return 'failed'
+    if timed_out.is_set():
+        return 'timeout'
+    return 'done'
+
+def load_skipped_pages(backdir):
+    skipped = {}
+    for skipped_path in glob.glob(os.path.join(backdir, 'skipped-*')):
+        with open(skipped_path) as f:
+            for line in f:
+                pageid, title, reason = d(line).rstrip('\n').split('\t')
+                skipped[pageid] = (title, reason)
+    return skipped
+
+def checkpoint_pages(pageids):
+    '''Checkpoints `pageids` as done without writing any rows for them.'''
+
+    writer = RowsWriter(
+        chdb.init_scratch_db(), cfg.parse_live_write_batch_size)
+    for batch in wpapi.batches(
+        sorted(pageids), cfg.parse_live_write_batch_size):
+        writer.add(batch, [])
+    writer.flush()
+
+def load_done_pages(pageids):
+    '''Returns the pageids in `pageids` that are in the checkpoint.'''
+
+    done = set()
+    with chdb.init_scratch_db() as cursor:
+        for chunk, in_pageids in chdb.in_chunks(pageids):
+            cursor.execute('''
+                SELECT page_id FROM parse_live_checkpoint
+                WHERE page_id IN %s''' % in_pageids, chunk)
+            done.update(str(row[0]) for row in cursor)
+    return done
+
+def write_skipped_pages_report(skipped, retried, done):
+    '''Writes the skipped pages along with the outcome of retrying them:
+    'done', 'skipped' if the retry didn't finish them, or 'not attempted' if
+    they weren't retried.'''
+
+    mkdir_p(cfg.log_dir)
+    report_path = os.path.join(
+        cfg.log_dir, 'parse_live_skipped_%s.tsv' % cfg.lang_code)
+    with open(report_path, 'w') as f:
+        for pageid, (title, reason) in sorted(skipped.items()):
+            if pageid in done:
+                outcome = 'done'
+            elif pageid in retried:
+                outcome = 'skipped'
+            else:
+                outcome = 'not attempted'
+            print >>f, e('\t'.join((pageid, title, reason, outcome)))
+    log.info('skipped %d pages, see %s' % (len(skipped), report_path))
+
+def live_db_has_revisions(cursor):
+    cursor.execute("SHOW COLUMNS FROM articles LIKE 'rev_id'")
+    return cursor.fetchone() is not None
+
+def load_live_revisions():
+    '''Returns a dict page id -> revision id for the articles in the live
+    database, or None if it predates revision ids.'''
+
+    with chdb.init_db(cfg.lang_code) as cursor:
+        if not live_db_has_revisions(cursor):
+            return None
+        cursor.execute(
+            'SELECT page_id, rev_id FROM articles WHERE rev_id IS NOT NULL')
+        return {str(page_id): rev_id for page_id, rev_id in cursor}
+
+def plan_tasks(pageids, live_revisions = None):
+    '''Splits the pageids into tasks for the pipeline, largest pages first,
+    so the slowest pages don't end up alone at the end of the run.
+
+    Each task is a list of pageids and their lengths, which we look up in
+    parallel as it takes a few requests. If `live_revisions` is given, the
+    pages whose latest revision is in it are copied from the live database
+    instead.
+    '''
+
+    lengths = {}
+    unchanged = []
+    pool = multiprocessing.pool.ThreadPool(cfg.parse_live_fetch_threads)
+    for batch_info in pool.imap_unordered(self.api.get_page_info,
+        wpapi.batches(pageids, wpapi.MAX_PAGES_PER_QUERY)):
+        for pageid, (length, rev_id) in batch_info.items():
+            if live_revisions is not None and \
+                live_revisions.get(pageid) == rev_id:
+                unchanged.append(pageid)
+            else:
+                lengths[pageid] = length
+    pool.close()
+    pool.join()
 
-    def insert(cursor, r):
-        cursor.execute('''
-            INSERT INTO articles VALUES(%s, %s, %s)''', r['article'])
-        cursor.executemany('''
-            INSERT IGNORE INTO snippets VALUES(%s, %s, %s, %s)''',
-            r['snippets'])
-    for r in rows:
-        self.chdb.execute_with_retry(insert, r)
-
-def parse_live(pageids, timeout):
-    chdb.reset_scratch_db()
+    if unchanged:
+        log.info('copying %d unchanged pages from the live database' %
+                 len(unchanged))
+        chdb.copy_articles_to_scratch_db(unchanged)
+
+    tasks = [(batch, {p: lengths[p] for p in batch})
+             for batch in wpapi.batch_by_length(lengths)]
+    # These will be reported as missing when fetching them
+    unchanged = set(unchanged)
+    missing = [p for p in pageids if p not in lengths and p not in unchanged]
+    tasks.extend((batch, None) for batch in wpapi.batches(
+        missing, wpapi.MAX_PAGES_PER_QUERY))
+    return tasks
+
+def submit_pageids(pool, worker, pageids, lengths = None):
+    pages = fetch_pages(pageids, lengths)
+    if pages is None:
+        # Fetching failed, so none of these pageids are done
+        pageids, pages = [], []
+    return pool.apply_async(worker, (pageids, pages))
+
+def scratch_db_has_checkpoint():
+    with chdb.init_scratch_db() as cursor:
+        cursor.execute("SHOW TABLES LIKE 'parse_live_checkpoint'")
+        return cursor.fetchone() is not None
+
+def load_checkpoint():
+    with chdb.init_scratch_db() as cursor:
+        cursor.execute('SELECT page_id FROM parse_live_checkpoint')
+        return set(str(row[0]) for row in cursor)
+
+def iter_stream_tasks(pageids_file, resume):
+    '''Yields tasks for the pipeline as the pageid file is read, so memory
+    use doesn't depend on its size. When resuming, the pageids that are done
+    are looked up in the checkpoint one task at a time.
+    '''
+
+    db = chdb.init_scratch_db() if resume else None
+    with open(pageids_file) as f:
+        lines = itertools.imap(str.strip, f)
+        while True:
+            chunk = list(itertools.islice(lines, wpapi.MAX_PAGES_PER_QUERY))
+            if not chunk:
+                break
+            batch = [p for p in chunk if p]
+            if db is not None and batch:
+                with db as cursor:
+                    cursor.execute('''
+                        SELECT page_id FROM parse_live_checkpoint
+                        WHERE page_id IN (%s)''' % ','.join(
+                            ['%s'] * len(batch)), batch)
+                    done = set(str(row[0]) for row in cursor)
+                batch = [p for p in batch if p not in done]
+            if batch:
+                yield (batch, None)
+
+def load_delta(delta_file):
+    '''Returns the sets of added, removed and unchanged pageids in a delta
+    file.'''
+
+    delta = {'+': set(), '-': set(), '=': set()}
+    with open(delta_file) as f:
+        for line in itertools.imap(str.strip, f):
+            if line:
+                delta[line[0]].add(line[1:])
+    return delta['+'], delta['-'], delta['=']
+
+def parse_live(pageids_file, timeout, dump = None, dump_index = None,
+               resume = False, stream = False, incremental = False,
+               delta = False):
+    # The process pool lives in the manager's process, which we start before
+    # any threads, so none of them can be holding a lock when the pool forks
+    # a new worker
+    manager = multiprocessing.Manager()
+
+    if resume and not scratch_db_has_checkpoint():
+        log.info('no previous run to resume, starting over')
+        resume = False
+    pageids = None
+    unchanged = set()
+    if delta:
+        added, removed, unchanged = load_delta(pageids_file)
+        log.info('%d pages added, %d removed and %d unchanged' % (
+            len(added), len(removed), len(unchanged)))
+        pageids = added
+        if incremental:
+            # Let plan_tasks decide which unchanged pages to copy
+            pageids |= unchanged
+            unchanged = set()
+        elif unchanged:
+            with chdb.init_db(cfg.lang_code) as cursor:
+                if not live_db_has_revisions(cursor):
+                    log.info('no revisions in the live database, '
+                             'parsing all pages')
+                    pageids |= unchanged
+                    unchanged = set()
+    elif not stream:
+        with open(pageids_file) as pf:
+            pageids = set(itertools.imap(str.strip, pf))
+        pageids.discard('')
+    if resume:
+        if not stream:
+            done = load_checkpoint()
+            log.info('resuming, %d pages were already done' % len(done))
+            pageids -= done
+            unchanged -= done
+    else:
+        chdb.reset_scratch_db()
+    if unchanged:
+        log.info('copying %d unchanged pages from the live database' %
+                 len(unchanged))
+        chdb.copy_articles_to_scratch_db(unchanged)
     backdir = tempfile.mkdtemp(prefix = 'citationhunt_parse_live_')
-    pool = multiprocessing.Pool(
-        initializer = initializer, initargs = (backdir,))
 
-    # Make sure we query the API 32 pageids at a time
-    tasks = []
-    batch_size = 32
-    pageids_list = list(pageids)
-    for i in range(0, len(pageids), batch_size):
-        tasks.append(pageids_list[i:i+batch_size])
-
-    result = pool.map_async(work, tasks)
+    self.api = wpapi.create_wikipedia_api(cfg)
+
+    # Load the templates once here rather than in each worker
+    citation_needed_templates = snippet_parser.load_citation_needed_templates(
+        self.api, cfg)
+    # Only work_dump needs the pageids, so don't copy them to every worker
+    # otherwise
+    pool = manager.Pool(
+        processes = cfg.parse_live_parse_processes,
+        initializer = initializer,
+        initargs = (backdir, citation_needed_templates,
+                    pageids if dump is not None else None, dump),
+        maxtasksperchild = cfg.parse_live_max_tasks_per_worker)
+
+    deadline = time.time() + timeout
+    if dump is not None:
+        if dump_index is not None:
+            byte_ranges = dumps.read_multistream_index(
+                dump, dump_index, pageids, DUMP_CHUNK_SIZE)
+        else:
+            byte_ranges = dumps.split_multistream(dump, DUMP_CHUNK_SIZE)
+        # Largest first, as ranges merged using the index vary in size
+        byte_ranges.sort(key = lambda (start, end): end - start,
+                         reverse = True)
+        status = run_pipeline(byte_ranges,
+            lambda byte_range: pool.apply_async(work_dump, (byte_range,)),
+            deadline)
+    else:
+        if stream:
+            tasks = iter_stream_tasks(pageids_file, resume)
+        else:
+            live_revisions = None
+            if incremental:
+                live_revisions = load_live_revisions()
+                if live_revisions is None:
+                    log.info('no revisions in the live database, '
+                             'parsing all pages')
+            log.info('looking up the length of %d pages' % len(pageids))
+            tasks = plan_tasks(pageids, live_revisions)
+        status = run_pipeline(tasks,
+            lambda (pageids, lengths): submit_pageids(
+                pool, work, pageids, lengths),
+            deadline)
+
+    skipped = load_skipped_pages(backdir)
+    if dump is not None and status == 'done':
+        # Like the pages the API doesn't return, the ones that aren't in the
+        # dump are done, so --resume doesn't look for them again
+        missing = pageids - load_checkpoint() - set(skipped)
+        if missing:
+            log.info('could not find pages %s in the dump' %
+                     ', '.join(sorted(missing)))
+            checkpoint_pages(missing)
+    retried = set()
+    def submit_retry(pageids):
+        retried.update(pageids)
+        return submit_pageids(pool, work_without_budget, pageids)
+    # Retrying goes to the API, so don't do it for reproducible dump runs
+    if status == 'done' and skipped and \
+        cfg.parse_live_retry_skipped_pages and dump is None:
+        # One page per task, so the slow pages are spread across workers
+        log.info('retrying %d skipped pages' % len(skipped))
+        status = run_pipeline([[pageid] for pageid in sorted(skipped)],
+            submit_retry, deadline)
     pool.close()
 
-    result.wait(timeout)
-    if not result.ready():
-        log.info('timeout, canceling the process pool!')
+    if status == 'timeout':
+        log.info('timeout, canceling the process pool! '
+                 'Use --resume to continue.')
         pool.terminate()
     pool.join()
-    try:
-        result.get()
-        ret = 0
-    except Exception:
+    manager.shutdown()
+    if status == 'failed':
         log.info('Too many exceptions, failed!')
         ret = 1
+    else:
+        ret = 0
+
+    if skipped:
+        done = load_done_pages(retried) if retried else set()
+        write_skipped_pages_report(skipped, retried, done)
+    log_memory_report(load_memory_report(backdir))
 
     if cfg.profile:
         profiles = map(pstats.Stats,
@@ -222,11 +790,12 @@ def parse_live(pageids, timeout):
 
 if __name__ == '__main__':
     arguments = docopt.docopt(__doc__)
-    pageids_file = arguments['<pageid-file>']
     timeout = float(arguments['--timeout'])
     start = time.time()
-    with open(pageids_file) as pf:
-        pageids = set(itertools.imap(str.strip, pf))
-    ret = parse_live(pageids, timeout)
+    ret = parse_live(
+        arguments['<pageid-file>'], timeout, arguments['--dump'],
+        arguments['--dump-index'], arguments['--resume'],
+        arguments['--stream'], arguments['--incremental'],
+        arguments['--delta'])
     log.info('all done in %d seconds.' % (time.time() - start))
     sys.exit(ret)
@@ -23,9 +23,9 @@ if _upper_dir not in sys.path:
 
 import config
 import snippet_parser
+import wpapi
 
 import docopt
-import wikitools
 
 import pprint
 import subprocess
@@ -50,22 +50,20 @@ if __name__ == '__main__':
     arguments = docopt.docopt(__doc__)
     cfg = config.get_localized_config()
 
-    WIKIPEDIA_BASE_URL = 'https://' + cfg.wikipedia_domain
-    WIKIPEDIA_WIKI_URL = WIKIPEDIA_BASE_URL + '/wiki/'
-    WIKIPEDIA_API_URL = WIKIPEDIA_BASE_URL + '/w/api.php'
-
-    wikipedia = wikitools.wiki.Wiki(WIKIPEDIA_API_URL)
+    wikipedia = wpapi.create_wikipedia_api(cfg)
     parser = snippet_parser.create_snippet_parser(wikipedia, cfg)
 
-    try:
-        int(arguments['<title_or_pageid>'])
-        page = wikitools.Page(
-            wikipedia, pageid = int(arguments['<title_or_pageid>']))
-    except:
-        page = wikitools.Page(
-            wikipedia, title = arguments['<title_or_pageid>'])
-
-    wikitext = page.getWikiText()
+    title_or_pageid = arguments['<title_or_pageid>']
+    if title_or_pageid.isdigit():
+        pages, _ = wikipedia.get_pages([title_or_pageid])
+        page = pages[0] if pages else None
+    else:
+        page = wikipedia.get_page_by_title(title_or_pageid)
+    if page is None:
+        print >> sys.stderr, 'No such page!'
+        sys.exit(1)
+
+    _, _, wikitext, _ = page
     for section, snippets in parser.extract(wikitext):
         if not snippets: continue
         _print('Section: %s' % section)
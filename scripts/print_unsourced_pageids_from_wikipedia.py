@@ -1,5 +1,29 @@
 #!/usr/bin/env python
 
+'''
+Print the pageids of all articles in the citation needed category (or any of
+its subcategories) configured in config.py, each once.
+
+The subcategories are visited breadth-first, up to the depth and number of
+categories configured in config.py.
+
+The categories are normally read from the Wikipedia database. Alternatively,
+they can be read from the page.sql.gz and categorylinks.sql.gz dumps, which
+don't need to be imported into MySQL first.
+
+The pageids can also be compared to the articles in the live CitationHunt
+database, and the difference written to a delta file for parse_live.py. It has
+one pageid per line, prefixed with + if the page was added, - if it was
+removed, or = if it is in both.
+
+Usage:
+    print_unsourced_pageids_from_wikipedia.py [--delta=<file>]
+    print_unsourced_pageids_from_wikipedia.py <page-dump> <categorylinks-dump> [--delta=<file>]
+
+Options:
+    --delta=<file>    Also write the delta file.
+'''
+
 import os
 import sys
 _upper_dir = os.path.abspath(
@@ -9,32 +33,169 @@ if _upper_dir not in sys.path:
 
 import chdb
 import config
+import dumps
+from utils import *
+
+import docopt
+
+log = Logger()
+
+class CategoryLimits(object):
+    '''Decides which categories to visit, up to a maximum depth below the
+    root category and a maximum number of categories.'''
+
+    def __init__(self, max_depth, max_categories):
+        self.max_depth = max_depth
+        self.max_categories = max_categories
+        self.truncated = False
+
+    def can_visit_level(self, depth):
+        if self.max_depth is not None and depth > self.max_depth:
+            self.truncated = True
+            return False
+        return True
+
+    def can_visit(self, visited):
+        if self.max_categories is not None and \
+            len(visited) >= self.max_categories:
+            self.truncated = True
+            return False
+        return True
+
+    def log(self, visited, depth):
+        log.info('visited %d categories, %d levels deep%s' % (
+            len(visited), depth,
+            ' (limit reached)' if self.truncated else ''))
+
+def iter_category_members(cursor, root, limits,
+                          chunk_size = chdb.IN_CHUNK_SIZE):
+    '''Yields the page ids of the pages in the category `root` or any of its
+    subcategories, each once.
+
+    The categories are visited breadth-first, looking up the categories at
+    each level in chunks of `chunk_size`. Each category is only visited once,
+    so cycles in the category graph are fine.
+    '''
 
-def print_unsourced_ids_from_wikipedia():
+    visited = set([root])
+    visited_subcategory_ids = set()
+    page_ids = set()
+    categories = [root]
+    depth = 0
+    while categories:
+        subcategory_ids = set()
+        for chunk, in_categories in chdb.in_chunks(categories, chunk_size):
+            cursor.execute('''
+                SELECT cl_from, cl_type FROM categorylinks
+                WHERE cl_to IN %s AND cl_type IN ('page', 'subcat')
+                ''' % in_categories, chunk)
+            for page_id, type in cursor.fetchall():
+                if type == 'subcat':
+                    subcategory_ids.add(page_id)
+                elif page_id not in page_ids:
+                    page_ids.add(page_id)
+                    yield page_id
+        subcategory_ids -= visited_subcategory_ids
+        if not subcategory_ids or not limits.can_visit_level(depth + 1):
+            break
+        visited_subcategory_ids |= subcategory_ids
+
+        # need to convert the page ids of subcategories into page
+        # titles so we can query recursively
+        categories = []
+        for chunk, in_page_ids in chdb.in_chunks(
+            sorted(subcategory_ids), chunk_size):
+            cursor.execute(
+                'SELECT page_title FROM page WHERE page_id IN %s' %
+                in_page_ids, chunk)
+            for title, in cursor.fetchall():
+                if title not in visited and limits.can_visit(visited):
+                    visited.add(title)
+                    categories.append(title)
+        depth += 1
+    limits.log(visited, depth)
+
+def make_category_limits(cfg):
+    return CategoryLimits(
+        cfg.unsourced_category_max_depth,
+        cfg.unsourced_category_max_categories)
+
+def iter_unsourced_ids_from_wikipedia():
     cfg = config.get_localized_config()
     db = chdb.init_wp_replica_db()
-    cursor = db.cursor()
-    categories = set([cfg.citation_needed_category])
+    return iter_category_members(
+        db.cursor(), cfg.citation_needed_category,
+        make_category_limits(cfg))
+
+def load_categories_from_dumps(cfg, page_dump, categorylinks_dump):
+    '''Returns the citation needed category and all of its subcategories.'''
+
+    subcategories = dumps.load_category_members(categorylinks_dump, 'subcat')
+    titles = dumps.load_page_titles(
+        page_dump, dumps.CATEGORY_NAMESPACE,
+        set(page_id for ids in subcategories.values() for page_id in ids))
+    limits = make_category_limits(cfg)
+    root = e(cfg.citation_needed_category)
+    categories = set([root])
+    to_visit = [root]
+    depth = 0
     while True:
-        cursor.execute(
-            'SELECT cl_from, cl_type FROM categorylinks WHERE (' +
-            ' OR '.join(['cl_to = %s'] * len(categories)) + ')', categories)
-        subcategories = set()
-        for page_id, type in cursor:
-            if type == 'page':
-                print page_id
-            elif type == 'subcat':
-                subcategories.add(page_id)
-        if not subcategories:
+        subcategory_titles = [titles[page_id]
+            for category in to_visit
+            for page_id in subcategories.get(category, [])
+            if page_id in titles and titles[page_id] not in categories]
+        if not subcategory_titles or not limits.can_visit_level(depth + 1):
             break
+        to_visit = []
+        for title in subcategory_titles:
+            if title not in categories and limits.can_visit(categories):
+                categories.add(title)
+                to_visit.append(title)
+        depth += 1
+    limits.log(categories, depth)
+    return categories
 
-        # need to convert the page ids of subcategories into page
-        # titles so we can query recursively
-        cursor.execute(
-            'SELECT page_title FROM page WHERE (' +
-            ' OR '.join(['page_id = %s'] * len(subcategories)) + ')',
-            subcategories)
-        categories = set([r[0] for r in cursor])
+def iter_unsourced_ids_from_dumps(page_dump, categorylinks_dump):
+    cfg = config.get_localized_config()
+    categories = load_categories_from_dumps(
+        cfg, page_dump, categorylinks_dump)
+    pages = dumps.load_category_members(categorylinks_dump, 'page', categories)
+    seen = set()
+    for page_ids in pages.values():
+        for page_id in page_ids:
+            if page_id not in seen:
+                seen.add(page_id)
+                yield page_id
+
+def write_delta(page_ids, delta_path):
+    cfg = config.get_localized_config()
+    with chdb.init_db(cfg.lang_code) as cursor:
+        cursor.execute('SELECT page_id FROM articles')
+        live_page_ids = set(row[0] for row in cursor)
+
+    added = page_ids - live_page_ids
+    removed = live_page_ids - page_ids
+    unchanged = page_ids & live_page_ids
+    with open(delta_path, 'w') as f:
+        for prefix, delta_page_ids in [
+            ('+', added), ('-', removed), ('=', unchanged)]:
+            for page_id in sorted(delta_page_ids):
+                print >>f, '%s%d' % (prefix, page_id)
+    log.info('%d pages added, %d removed and %d unchanged' % (
+        len(added), len(removed), len(unchanged)))
 
 if __name__ == '__main__':
-    print_unsourced_ids_from_wikipedia()
+    args = docopt.docopt(__doc__)
+    if args['<page-dump>'] is not None:
+        page_ids = iter_unsourced_ids_from_dumps(
+            args['<page-dump>'], args['<categorylinks-dump>'])
+    else:
+        page_ids = iter_unsourced_ids_from_wikipedia()
+
+    delta_page_ids = set()
+    for page_id in page_ids:
+        print page_id
+        if args['--delta'] is not None:
+            delta_page_ids.add(int(page_id))
+    if args['--delta'] is not None:
+        write_delta(delta_page_ids, args['--delta'])
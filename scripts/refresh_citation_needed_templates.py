@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+'''
+Refresh the cached list of citation needed templates and the templates that
+redirect to them, which the snippet parser otherwise reuses for a while
+(see citation_needed_templates_cache_hours in ../config.py).
+
+Usage:
+    refresh_citation_needed_templates.py <lang-code>
+
+Use 'global' for lang-code to go over all languages.
+'''
+
+from __future__ import unicode_literals
+
+import os
+import sys
+_upper_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+if _upper_dir not in sys.path:
+    sys.path.append(_upper_dir)
+
+import config
+import snippet_parser
+import wpapi
+from utils import *
+
+import docopt
+
+log = Logger()
+
+def refresh_citation_needed_templates(cfg):
+    templates = snippet_parser.load_citation_needed_templates(
+        wpapi.create_wikipedia_api(cfg), cfg, refresh = True)
+    log.info('%s: %d templates (%s)' % (
+        cfg.lang_code, len(templates), ', '.join(sorted(templates))))
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    lang_codes = (
+        config.LANG_CODES_TO_LANG_NAMES.keys()
+        if args['<lang-code>'] == 'global'
+        else [args['<lang-code>']])
+
+    for lang_code in lang_codes:
+        refresh_citation_needed_templates(
+            config.get_localized_config(lang_code))
@@ -110,8 +110,8 @@ def _update_db_tools_labs(cfg):
 
     unsourced = tempfile.NamedTemporaryFile()
     run_script(
-        'print_unsourced_pageids_from_wikipedia.py', wp_my_cnf + ' > ' +
-        unsourced.name)
+        'print_unsourced_pageids_from_wikipedia.py', '> ' + unsourced.name)
+    run_script('refresh_citation_needed_templates.py', cfg.lang_code)
     run_script('parse_live.py', unsourced.name)
     run_script('assign_categories.py')
     run_script('install_new_database.py')
@@ -1,4 +1,4 @@
 from core import (
     REF_MARKER, CITATION_NEEDED_MARKER,
-    create_snippet_parser
+    create_snippet_parser, load_citation_needed_templates
 )
@@ -0,0 +1,168 @@
+'''
+On-disk caches for the snippet parser, so repeated runs don't have to go to
+the Wikipedia API for things that haven't changed.
+'''
+
+from __future__ import unicode_literals
+
+import os
+import sys
+
+_upper_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+if _upper_dir not in sys.path:
+    sys.path.append(_upper_dir)
+
+from utils import *
+
+import contextlib
+import hashlib
+import json
+import sqlite3
+import tempfile
+import time
+
+class SnippetHTMLCache(object):
+    '''A cache of the HTML rendered for snippets, stored in SQLite.
+
+    Entries are keyed by a hash of everything that goes into the HTML we
+    store: the language, the snippet wikitext and the CSS selectors we
+    strip. When there are more than `max_entries` entries, the least
+    recently used ones are evicted.
+
+    The cache may be shared by many processes. It uses SQLite's write-ahead
+    log, so reads don't wait for writes, and anything that can't get hold of
+    the database for LOCK_TIMEOUT_SECONDS is treated as a cache miss rather
+    than an error.
+    '''
+
+    # How many insertions between checks for eviction
+    EVICTION_INTERVAL = 1000
+
+    # How old the last use of an entry must be for a read to update it.
+    # Updating takes the write lock, so we don't want to do it on every read,
+    # and eviction doesn't need to be more precise than this anyway.
+    TOUCH_INTERVAL_SECONDS = 60 * 60
+
+    # How long to wait for other processes to release the database
+    LOCK_TIMEOUT_SECONDS = 5
+
+    def __init__(self, path, lang_code, css_selectors, max_entries):
+        mkdir_p(os.path.dirname(path))
+        self._db = sqlite3.connect(path, timeout = self.LOCK_TIMEOUT_SECONDS)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS snippet_html (key TEXT PRIMARY KEY,
+            html TEXT, last_used INTEGER)''')
+        self._db.execute('''
+            CREATE INDEX IF NOT EXISTS snippet_html_last_used
+            ON snippet_html (last_used)''')
+        self._db.commit()
+        self._key_prefix = e(lang_code + '\0' + '\0'.join(css_selectors) + '\0')
+        self._max_entries = max_entries
+        self._insertions = 0
+        self._evict()
+
+    def key(self, snippet):
+        return hashlib.sha1(self._key_prefix + e(snippet)).hexdigest()
+
+    def get_many(self, snippets):
+        '''Returns a dict snippet -> html for the snippets in the cache.'''
+
+        keys_to_snippets = {}
+        for snippet in snippets:
+            keys_to_snippets[self.key(snippet)] = snippet
+
+        found = {}
+        stale_keys = []
+        now = int(time.time())
+        with self._unless_locked():
+            for chunk, params in self._chunks(keys_to_snippets.keys()):
+                for key, html, last_used in self._db.execute(
+                    'SELECT key, html, last_used FROM snippet_html '
+                    'WHERE key IN (%s)' % params, chunk):
+                    found[keys_to_snippets[key]] = html
+                    if now - last_used >= self.TOUCH_INTERVAL_SECONDS:
+                        stale_keys.append(key)
+
+        if stale_keys:
+            with self._unless_locked(), self._db:
+                for chunk, params in self._chunks(stale_keys):
+                    self._db.execute(
+                        'UPDATE snippet_html SET last_used = ? '
+                        'WHERE key IN (%s)' % params, [now] + chunk)
+        return found
+
+    @contextlib.contextmanager
+    def _unless_locked(self):
+        '''Gives up on the block if other processes keep the database
+        locked for too long.'''
+
+        try:
+            yield
+        except sqlite3.OperationalError as e:
+            # Python 2's sqlite3 doesn't tell us the error code
+            if 'locked' not in str(e) and 'busy' not in str(e):
+                raise
+
+    def _chunks(self, keys):
+        for i in range(0, len(keys), 500):  # SQLITE_MAX_VARIABLE_NUMBER
+            chunk = keys[i:i+500]
+            yield chunk, ','.join(['?'] * len(chunk))
+
+    def put_many(self, snippets_and_htmls):
+        now = int(time.time())
+        rows = [(self.key(snippet), html, now)
+                for snippet, html in snippets_and_htmls]
+        with self._unless_locked(), self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO snippet_html VALUES (?, ?, ?)', rows)
+
+        self._insertions += len(rows)
+        if self._insertions >= self.EVICTION_INTERVAL:
+            self._insertions = 0
+            self._evict()
+
+    def _evict(self):
+        with self._unless_locked(), self._db:
+            count = self._db.execute(
+                'SELECT COUNT(*) FROM snippet_html').fetchone()[0]
+            if count <= self._max_entries:
+                return
+            self._db.execute('''
+                DELETE FROM snippet_html WHERE key IN (
+                SELECT key FROM snippet_html ORDER BY last_used LIMIT ?)''',
+                (count - self._max_entries,))
+
+    def close(self):
+        self._db.close()
+
+class JSONFileCache(object):
+    '''A single JSON value stored in a file, which expires after a while.
+
+    Writes are atomic, so the file can be read by many processes.
+    '''
+
+    def __init__(self, path, max_age_seconds):
+        self._path = path
+        self._max_age_seconds = max_age_seconds
+
+    def get(self):
+        '''Returns the cached value, or None if it is missing or expired.'''
+
+        try:
+            with open(self._path) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if time.time() - entry['timestamp'] > self._max_age_seconds:
+            return None
+        return entry['value']
+
+    def put(self, value):
+        dirname = os.path.dirname(self._path)
+        mkdir_p(dirname)
+        fd, tmp_path = tempfile.mkstemp(dir = dirname)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'timestamp': time.time(), 'value': value}, f)
+        os.rename(tmp_path, self._path)
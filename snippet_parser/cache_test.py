@@ -0,0 +1,83 @@
+#-*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+
+from cache import *
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+class SnippetHTMLCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = 'citationhunt_cache_test_')
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'cache', 'snippet_html.sqlite')
+
+    def make_cache(self, lang_code = 'ja', css_selectors = ('table',),
+            max_entries = 100):
+        cache = SnippetHTMLCache(
+            self.path, lang_code, css_selectors, max_entries)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_get_and_put(self):
+        cache = self.make_cache()
+        self.assertEqual(cache.get_many(['a', 'b']), {})
+        cache.put_many([('a', '<div>a</div>'), ('日本', '<div>日本</div>')])
+        self.assertEqual(cache.get_many(['a', 'b', '日本']),
+            {'a': '<div>a</div>', '日本': '<div>日本</div>'})
+
+        # Persisted across instances
+        self.assertEqual(self.make_cache().get_many(['a']),
+            {'a': '<div>a</div>'})
+
+    def test_key_includes_config(self):
+        self.make_cache().put_many([('a', '<div>a</div>')])
+        self.assertEqual(self.make_cache(lang_code = 'en').get_many(['a']), {})
+        self.assertEqual(self.make_cache(
+            css_selectors = ('table', '.noprint')).get_many(['a']), {})
+
+    def test_eviction(self):
+        cache = self.make_cache(max_entries = 10)
+        cache.EVICTION_INTERVAL = 1
+        for i in range(20):
+            cache.put_many([(unicode(i), '<div>%d</div>' % i)])
+        self.assertEqual(
+            sorted(cache.get_many(unicode(i) for i in range(20))),
+            sorted(unicode(i) for i in range(10, 20)))
+
+    def test_reads_only_touch_stale_entries(self):
+        cache = self.make_cache()
+        cache.put_many([('a', '<div>a</div>'), ('b', '<div>b</div>')])
+        changes = cache._db.total_changes
+        self.assertEqual(len(cache.get_many(['a', 'b'])), 2)
+        self.assertEqual(cache._db.total_changes, changes)
+
+        with cache._db:
+            cache._db.execute('UPDATE snippet_html SET last_used = 0')
+        changes = cache._db.total_changes
+        self.assertEqual(len(cache.get_many(['a', 'b'])), 2)
+        self.assertEqual(cache._db.total_changes, changes + 2)
+        self.assertEqual(cache._db.execute(
+            'SELECT COUNT(*) FROM snippet_html WHERE last_used = 0'
+            ).fetchone()[0], 0)
+
+    def test_locked_database_is_a_miss(self):
+        cache = self.make_cache()
+        cache.put_many([('a', '<div>a</div>')])
+        cache._db.execute('PRAGMA busy_timeout = 100')
+        self.assertEqual(cache._db.execute(
+            'PRAGMA journal_mode').fetchone()[0], 'wal')
+
+        other = sqlite3.connect(self.path)
+        self.addCleanup(other.close)
+        other.execute('BEGIN EXCLUSIVE')
+        # Writes are dropped, but reads still work with the write-ahead log
+        cache.put_many([('b', '<div>b</div>')])
+        self.assertEqual(cache.get_many(['a', 'b']), {'a': '<div>a</div>'})
+        other.rollback()
+
+if __name__ == '__main__':
+    unittest.main()
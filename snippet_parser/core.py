@@ -10,31 +10,148 @@ if _upper_dir not in sys.path:
     sys.path.append(_upper_dir)
 
 import config
+import wpapi
 from utils import *
+from cache import SnippetHTMLCache, JSONFileCache
+from renderer import render_wikitext, may_contain_free_link
 
 import mwparserfromhell
-import wikitools
+import requests
 
 import cStringIO as StringIO
 import re
 import importlib
 import itertools
+import lxml.etree
 import lxml.html
 import lxml.cssselect
 
 REF_MARKER = 'ec5b89dc49c433a9521a139'
 CITATION_NEEDED_MARKER = '7b94863f3091b449e6ab04d4'
 
+# Separates snippets that get converted to HTML in a single API request. It
+# becomes a paragraph of its own in the HTML.
+SNIPPET_SEPARATOR_MARKER = '1d8ac3a5e0b6e2f47c90e3f5'
+SNIPPET_SEPARATOR = '\n\n' + SNIPPET_SEPARATOR_MARKER + '\n\n'
+
+# The maximum total size of the snippets converted to HTML in a single request
+HTML_BATCH_MAX_SIZE = 50000
+
 STRIP_REGEXP = re.compile( # strip spaces before the markers
     '\s+(' + CITATION_NEEDED_MARKER + '|' + REF_MARKER + ')')
 
+# The tokens understood by the fast path in _fast_strip_paragraph. Anything
+# that doesn't match one of these (tables, external links, style markup,
+# nested templates...) makes us fall back to mwparserfromhell.
+FAST_PATH_TOKEN_REGEXP = re.compile(r'''
+    (?P<text>[^\[\]{}<']+|'(?!'))|
+    (?P<wikilink>\[\[[^\[\]{}<>|\n]+(?:\|[^\[\]{}<>|\n]+)?\]\])|
+    (?P<template>\{\{(?!\{)[^{}\[\]<>]*\}\})|
+    (?P<ref><ref(?:\s[^<>/{}\[\]]*)?(?:/>|>(?P<refcontents>[^<]*)</ref\s*>))|
+    (?P<comment><!--.*?-->)
+''', re.VERBOSE | re.DOTALL | re.UNICODE)
+
+# Markup at the start of a line (lists, headings, horizontal rules) that the
+# fast path doesn't handle.
+FAST_PATH_LINE_START_REGEXP = re.compile('(?:^|\n)(?:[*#:;=]|----)')
+
+# Text that mwparserfromhell would parse as an HTML entity.
+FAST_PATH_ENTITY_REGEXP = re.compile('&#?[a-zA-Z0-9]+;')
+
+# Template names inside <ref> contents, which we need to check against the
+# blacklist even though the contents themselves are dropped.
+FAST_PATH_TEMPLATE_NAME_REGEXP = re.compile('\{\{([^{}|]*)')
+
+FAST_PATH_MAX_CACHED_TOKENS = 10000
+
 def matches_any(template, names):
     return any(template.name.matches(n) for n in names)
 
+def _name_matches_any(name, names):
+    '''Like matches_any, but for a plain string template name.
+
+    This mimics mwparserfromhell's Wikicode.matches for names without markup.
+    '''
+    name = name.strip()
+    if not name:
+        return False
+    name = name[0].upper() + name[1:]
+    for n in names:
+        n = n.strip()
+        if n and n[0].upper() + n[1:] == name:
+            return True
+    return False
+
+def resolve_redirects_to_templates(wikipedia, templates):
+    templates = set(templates)
+    params = {
+        'action': 'query',
+        'prop': 'redirects',
+        'titles': '|'.join(
+            # The API resolves Template: to the relevant per-language prefix
+            'Template:' + tplname
+            for tplname in templates
+        ),
+        'rnamespace': 10,
+    }
+    # We could fall back to just using the templates we were given
+    # if the API request fails, but for now let's just crash
+    for result in wikipedia.query_continue(params):
+        for page in result['query']['pages'].values():
+            for redirect in page.get('redirects', []):
+                # TODO We technically only need to keep the templates that
+                # mwparserfromhell will consider different from one another
+                # (e.g., no need to have both Cn and CN)
+                if ':' not in redirect['title']:
+                    # Not a template?
+                    continue
+                tplname = redirect['title'].split(':', 1)[1]
+                templates.add(tplname)
+    return templates
+
+def load_citation_needed_templates(wikipedia, cfg, refresh = False):
+    '''Returns the citation needed templates for a language, along with all
+    templates that redirect to them.
+
+    Resolving redirects takes a few API requests, so the result is cached in
+    cfg.cache_dir for cfg.citation_needed_templates_cache_hours. Pass
+    `refresh` to ignore the cached value.
+    '''
+
+    if wikipedia is None:
+        # Testing
+        return set(cfg.citation_needed_templates)
+    if not cfg.cache_dir:
+        return resolve_redirects_to_templates(
+            wikipedia, cfg.citation_needed_templates)
+
+    cache = JSONFileCache(
+        os.path.join(cfg.cache_dir,
+            'citation_needed_templates_%s.json' % cfg.lang_code),
+        cfg.citation_needed_templates_cache_hours * 60 * 60)
+    cached = cache.get()
+    if (not refresh and cached is not None and
+        cached['configured'] == sorted(cfg.citation_needed_templates)):
+        return set(cached['resolved'])
+
+    templates = resolve_redirects_to_templates(
+        wikipedia, cfg.citation_needed_templates)
+    cache.put({
+        'configured': sorted(cfg.citation_needed_templates),
+        'resolved': sorted(templates),
+    })
+    return templates
+
 class SnippetParserBase(object):
     '''A base class for snippet parsers in various languages.'''
 
-    def __init__(self, wikipedia, cfg):
+    def __init__(self, wikipedia, cfg, citation_needed_templates = None):
+        '''Creates a snippet parser.
+
+        `citation_needed_templates` can be used to pass in the result of
+        load_citation_needed_templates, so it doesn't get loaded again.
+        '''
+
         self._cfg = cfg
         self._wikipedia = wikipedia
 
@@ -45,9 +162,11 @@ class SnippetParserBase(object):
             mwparserfromhell.nodes.Heading: self.strip_heading,
         }
 
+        if citation_needed_templates is None:
+            citation_needed_templates = load_citation_needed_templates(
+                self._wikipedia, self._cfg)
         self._lowercase_cn_templates = set(
-            t.lower() for t in self._resolve_redirects_to_templates(
-                self._cfg.citation_needed_templates))
+            t.lower() for t in citation_needed_templates)
         assert len(self._lowercase_cn_templates) > 0
 
         self._html_css_selectors_to_strip = [
@@ -55,37 +174,17 @@ class SnippetParserBase(object):
             for css_selector in self._cfg.html_css_selectors_to_strip
         ]
 
-    def _resolve_redirects_to_templates(self, templates):
-        templates = set(templates)
-        if self._wikipedia is None:
-            # Testing
-            return templates
-        params = {
-            'action': 'query',
-            'format': 'json',
-            'prop': 'redirects',
-            'titles': '|'.join(
-                # The API resolves Template: to the relevant per-language prefix
-                'Template:' + tplname
-                for tplname in self._cfg.citation_needed_templates
-            ),
-            'rnamespace': 10,
-        }
-        request = wikitools.APIRequest(self._wikipedia, params)
-        # We could fall back to just using self._cfg.citation_needed_templates
-        # if the API request fails, but for now let's just crash
-        for result in request.queryGen():
-            for page in result['query']['pages'].values():
-                for redirect in page.get('redirects', []):
-                    # TODO We technically only need to keep the templates that
-                    # mwparserfromhell will consider different from one another
-                    # (e.g., no need to have both Cn and CN)
-                    if ':' not in redirect['title']:
-                        # Not a template?
-                        continue
-                    tplname = redirect['title'].split(':', 1)[1]
-                    templates.add(tplname)
-        return templates
+        # token -> stripped text (or None if blacklisted), for the fast path
+        self._fast_path_cache = {}
+
+        self._html_cache = None
+        if (self._cfg.html_snippet and self._cfg.cache_dir and
+            self._wikipedia is not None):
+            self._html_cache = SnippetHTMLCache(
+                os.path.join(self._cfg.cache_dir,
+                    'snippet_html_%s.sqlite' % self._cfg.lang_code),
+                self._cfg.lang_code, self._cfg.html_css_selectors_to_strip,
+                self._cfg.snippet_html_cache_max_entries)
 
     def _strip_code(self, wikicode, normalize=True, collapse=True):
         '''A copy of mwparserfromhell's strip_code, using our methods.'''
@@ -108,6 +207,93 @@ class SnippetParserBase(object):
         else:
 	    return "".join(nodes)
 
+    def _fast_strip_paragraph(self, paragraph):
+        '''A faster equivalent of stripping a plain text paragraph.
+
+        Handles paragraphs consisting only of text, simple wikilinks and
+        templates (without nested markup), <ref> tags and comments, which
+        covers most tagged paragraphs. Links and templates are still stripped
+        through the regular strip_* methods, but they are parsed in isolation
+        and cached, rather than parsing the whole paragraph.
+
+        Returns the same as self._strip_code(mwparserfromhell.parse(paragraph)),
+        or None if the paragraph contains anything we can't handle, including
+        blacklisted tags or templates, in which case the caller should fall
+        back to the regular path.
+        '''
+
+        if FAST_PATH_LINE_START_REGEXP.search(paragraph):
+            return None
+
+        nodes = []
+        pos = 0
+        while pos < len(paragraph):
+            m = FAST_PATH_TOKEN_REGEXP.match(paragraph, pos)
+            if m is None:
+                return None
+            pos = m.end()
+            kind = m.lastgroup
+            if kind == 'text':
+                text = m.group()
+                if '&' in text and FAST_PATH_ENTITY_REGEXP.search(text):
+                    return None
+                if ':' in text and may_contain_free_link(text):
+                    return None
+                nodes.append(text)
+            elif kind == 'ref':
+                stripped = self._fast_strip_ref(m.group('refcontents'))
+                if stripped is None:
+                    return None
+                nodes.append(stripped)
+            elif kind in ('wikilink', 'template'):
+                stripped = self._fast_strip_token(m.group())
+                if stripped is None:
+                    return None
+                nodes.append(stripped)
+            # comments are dropped
+
+        stripped = ''.join(nodes).strip('\n')
+        while '\n\n\n' in stripped:
+            stripped = stripped.replace('\n\n\n', '\n\n')
+        return stripped
+
+    def _fast_strip_token(self, token):
+        if "''" in token:
+            # Style markup may pair up with quotes elsewhere in the paragraph
+            return None
+        try:
+            return self._fast_path_cache[token]
+        except KeyError:
+            pass
+
+        wikicode = mwparserfromhell.parse(token)
+        if (len(wikicode.nodes) != 1 or
+            type(wikicode.get(0)) not in self._strip_methods or
+            self._has_blacklisted_tag_or_template(wikicode)):
+            stripped = None
+        else:
+            stripped = self._strip_code(wikicode)
+
+        if len(self._fast_path_cache) >= FAST_PATH_MAX_CACHED_TOKENS:
+            self._fast_path_cache.clear()
+        self._fast_path_cache[token] = stripped
+        return stripped
+
+    def _fast_strip_ref(self, contents):
+        if (self.strip_tag.__func__ is not SnippetParserBase.strip_tag.__func__):
+            # We can't know what the subclass wants to do with the contents
+            return None
+        if contents:
+            if (contents.count('{{') != contents.count('}}') or
+                contents.count('[[') != contents.count(']]')):
+                return None
+            for name in FAST_PATH_TEMPLATE_NAME_REGEXP.findall(contents):
+                if any(c in name for c in '[]&\''):
+                    return None
+                if _name_matches_any(name, self._cfg.templates_blacklist):
+                    return None
+        return REF_MARKER
+
     def _has_blacklisted_tag_or_template(self, wikicode):
         blacklisted_tag_or_template = itertools.chain(
             (tag.tag in self._cfg.tags_blacklist
@@ -203,6 +389,28 @@ class SnippetParserBase(object):
             return self.extract_snippets(wikitext)
         return self.extract_sections(wikitext)
 
+    def iter_extract(self, wikitext, predicate = None):
+        """Like `extract`, but yields (section, snippet) tuples as they are found.
+
+        If `predicate` is given, only the tuples for which predicate(section,
+        snippet) is True are yielded. Callers can stop iterating at any point
+        to skip parsing the rest of the page.
+
+        When `cfg.html_snippet` is True, all snippets in the page are converted
+        to HTML in a single batch, so the first tuple is only yielded after the
+        whole page has been parsed.
+        """
+
+        if self._cfg.extract == 'snippet':
+            records = self._iter_snippets(wikitext)
+        else:
+            records = self._iter_sections(wikitext)
+        for section, snippet in records:
+            if snippet is None:
+                continue
+            if predicate is None or predicate(section, snippet):
+                yield section, snippet
+
     def extract_snippets(self, wikitext):
         """Extracts snippets lacking citations.
 
@@ -218,7 +426,57 @@ class SnippetParserBase(object):
             ]
         """
 
+        return self._group_by_section(self._iter_snippets(wikitext))
+
+    def extract_sections(self, wikitext):
+        """Extracts sections/subsections lacking citations.
+
+        This function looks for sections of the article that are marked with any of
+        the templates in `cfg.citation_needed_templates`.
+
+        The return value is a list of lists of the form:
+            [
+                [<section1>, [<subsection1>, <subsection2>, ...]],
+                [<section2>, [<subsection1>, ...]],
+                ...
+            ]
+        """
+
+        return self._group_by_section(self._iter_sections(wikitext))
+
+    def _group_by_section(self, records):
         snippets = [] # [section, [snippets]]
+        for section, snippet in records:
+            if snippet is None:
+                snippets.append([section, []])
+            else:
+                snippets[-1][1].append(snippet)
+        return snippets
+
+    def _iter_html_candidates(self, html_candidates, accept):
+        """Converts the snippets in `html_candidates`, a list of (section,
+        snippet) tuples, to HTML in a single batch and yields the tuples for
+        which accept(html) is True. Tuples with a None snippet, which mark the
+        start of sections, are yielded unchanged.
+        """
+
+        htmls = iter(self._to_html_batch(
+            s for _, s in html_candidates if s is not None))
+        for section, snippet in html_candidates:
+            if snippet is None:
+                yield section, None
+                continue
+            snippet = next(htmls)
+            if accept(snippet):
+                yield section, snippet
+
+    def _iter_snippets(self, wikitext):
+        """Yields the (section, snippet) tuples for `extract_snippets`.
+
+        A (section, None) tuple is yielded at the start of each section.
+        """
+
+        html_candidates = [] # [(section, snippet)], when html_snippet
         minlen, maxlen = self._cfg.snippet_min_size, self._cfg.snippet_max_size
 
         wikicode = self._fast_parse(wikitext)
@@ -232,18 +490,26 @@ class SnippetParserBase(object):
             assert i == 0 or \
                 isinstance(section.get(0), mwparserfromhell.nodes.heading.Heading)
             sectitle = unicode(section.get(0).title.strip()) if i != 0 else ''
-            secsnippets = []
-            snippets.append([sectitle, secsnippets])
+            if not self._cfg.html_snippet:
+                yield sectitle, None
+            else:
+                html_candidates.append((sectitle, None))
 
             paragraphs = section.split('\n\n')
             for paragraph in paragraphs:
-                # Invoking a string method on a Wikicode object returns a string,
-                # so we need to parse it again :(
-                wikicode = mwparserfromhell.parse(paragraph)
-                if self._has_blacklisted_tag_or_template(wikicode):
-                    continue
+                snippet = None
+                if self._cfg.snippet_parser_fast_path and \
+                    not self._cfg.html_snippet:
+                    snippet = self._fast_strip_paragraph(paragraph)
+                if snippet is None:
+                    # Invoking a string method on a Wikicode object returns a
+                    # string, so we need to parse it again :(
+                    wikicode = mwparserfromhell.parse(paragraph)
+                    if self._has_blacklisted_tag_or_template(wikicode):
+                        continue
+                    snippet = self._strip_code(wikicode)
 
-                snippet = self._cleanup_snippet_text(self._strip_code(wikicode))
+                snippet = self._cleanup_snippet_text(snippet)
                 if not self._cfg.html_snippet and '\n' in snippet:
                     # Lists cause more 'paragraphs' to be generated
                     paragraphs.extend(snippet.split('\n'))
@@ -262,32 +528,24 @@ class SnippetParserBase(object):
                             snippet.count(REF_MARKER)))
                     if usable_len > maxlen or usable_len < minlen:
                         continue
+                    yield sectitle, snippet
                 else:
-                    # TODO Maybe batch all snippets and do a single API request?
-                    snippet = self._to_html(snippet)
-                    if not (minlen < len(snippet) < maxlen):
-                        continue
-                    if CITATION_NEEDED_MARKER not in snippet:
-                        # marker may have been removed in the HTML processing
-                        continue
-                secsnippets.append(snippet)
-        return snippets
+                    # Convert all snippets to HTML at once below
+                    html_candidates.append((sectitle, snippet))
 
-    def extract_sections(self, wikitext):
-        """Extracts sections/subsections lacking citations.
+        # The marker may have been removed in the HTML processing
+        for record in self._iter_html_candidates(html_candidates,
+            lambda snippet: minlen < len(snippet) < maxlen and
+                CITATION_NEEDED_MARKER in snippet):
+            yield record
 
-        This function looks for sections of the article that are marked with any of
-        the templates in `cfg.citation_needed_templates`.
+    def _iter_sections(self, wikitext):
+        """Yields the (section, snippet) tuples for `extract_sections`.
 
-        The return value is a list of lists of the form:
-            [
-                [<section1>, [<subsection1>, <subsection2>, ...]],
-                [<section2>, [<subsection1>, ...]],
-                ...
-            ]
+        A (section, None) tuple is yielded at the start of each section.
         """
 
-        snippets = [] # [section, [snippets]]
+        html_candidates = [] # [(section, snippet)]
         minlen, maxlen = self._cfg.snippet_min_size, self._cfg.snippet_max_size
         sections = mwparserfromhell.parse(wikitext).get_sections(
             include_lead = True, include_headings = True, flat = True)
@@ -299,8 +557,7 @@ class SnippetParserBase(object):
                 isinstance(section.get(0), mwparserfromhell.nodes.heading.Heading)
             sectitle = unicode(section.get(0).title.strip()) if i != 0 else ''
             seclevel = section.get(0).level if i != 0 else float('inf')
-            secsnippets = []
-            snippets.append([sectitle, secsnippets])
+            html_candidates.append((sectitle, None))
             i += 1
 
             for tpl in section.filter_templates():
@@ -347,10 +604,11 @@ class SnippetParserBase(object):
             # it will be smaller than the minimum size when converted to HTML.
             # FIXME: Maybe this can be detected?
             snippet = '\n\n'.join(p.strip(' ') for p in snippet.split('\n\n')[:10])
-            snippet = self._to_html(snippet)
-            if len(snippet) > minlen and len(snippet) < maxlen:
-                secsnippets.append(snippet)
-        return snippets
+            html_candidates.append((sectitle, snippet))
+
+        for record in self._iter_html_candidates(html_candidates,
+            lambda snippet: minlen < len(snippet) < maxlen):
+            yield record
 
     def _cleanup_snippet_text(self, snippet):
         snippet = re.sub(STRIP_REGEXP, r'\1', snippet).strip()
@@ -359,15 +617,13 @@ class SnippetParserBase(object):
         snippet = re.sub('\[\]\s', '', snippet)
         return snippet
 
-    def _cleanup_snippet_html(self, html):
-        tree = lxml.html.parse(
+    def _parse_html(self, html):
+        return lxml.html.parse(
             StringIO.StringIO(e(html)),
             parser = lxml.html.HTMLParser(
                 encoding = 'utf-8', remove_comments = True)).getroot()
-        if tree is None:
-            # TODO Log/investigate these
-            return ''
 
+    def _cleanup_snippet_tree(self, tree):
         # Links are always relative so they end up broken in the UI. We could make
         # them absolute, but let's just remove them (by replacing with <span>) since
         # we don't actually need them.
@@ -378,12 +634,92 @@ class SnippetParserBase(object):
             for element in css_selector(tree):
                 element.getparent().remove(element)
 
+    def _cleanup_snippet_html(self, html):
+        tree = self._parse_html(html)
+        if tree is None:
+            # TODO Log/investigate these
+            return ''
+        self._cleanup_snippet_tree(tree)
+
         # lxml wraps the HTML with proper <html><body> tags, so remove that
         newroot = tree.find('.//body')
         newroot.tag = 'div'
         return d(lxml.html.tostring(
             newroot, encoding = 'utf-8', method = 'html'))
 
+    def _cleanup_snippets_html(self, html, count):
+        """Cleans up the HTML for a batch of snippets.
+
+        The HTML is expected to be the rendering of `count` snippets joined by
+        SNIPPET_SEPARATOR. The return value is a list with the cleaned up HTML
+        for each snippet, as if it had been passed to _cleanup_snippet_html on
+        its own, or None if the HTML can't be split back into snippets.
+        """
+
+        tree = self._parse_html(html)
+        if tree is None:
+            return None
+        self._cleanup_snippet_tree(tree)
+        body = tree.find('.//body')
+
+        separators = [
+            p for p in body.iter('p')
+            if len(p) == 0 and (p.text or '').strip() == SNIPPET_SEPARATOR_MARKER
+        ]
+        if len(separators) != count - 1:
+            return None
+        if not separators:
+            body.tag = 'div'
+            return [d(lxml.html.tostring(
+                body, encoding = 'utf-8', method = 'html'))]
+
+        # All separators must be siblings, otherwise some markup in one of the
+        # snippets leaked into the others.
+        container = separators[0].getparent()
+        if any(sep.getparent() is not container for sep in separators):
+            return None
+
+        # The elements between the body and the separators, such as
+        # <div class="mw-parser-output">, which we replicate for every snippet
+        ancestors = []
+        element = container
+        while element is not body:
+            ancestors.append(element)
+            element = element.getparent()
+        ancestors.reverse()
+
+        def new_snippet_root(text):
+            root = parent = lxml.html.Element('div')
+            for ancestor in ancestors:
+                parent = lxml.etree.SubElement(
+                    parent, ancestor.tag, dict(ancestor.attrib))
+                parent.tail = ancestor.tail
+            parent.text = text
+            return root, parent
+
+        def strip_whitespace(text):
+            return text if (text or '').strip() else None
+
+        # MediaWiki separates block elements with newlines, so the separator
+        # and the element before it usually have a "\n" tail, which a snippet
+        # rendered on its own wouldn't have at its start or end
+        roots = []
+        root, parent = new_snippet_root(container.text)
+        for child in list(container):
+            if child in separators:
+                if len(parent):
+                    parent[-1].tail = strip_whitespace(parent[-1].tail)
+                roots.append(root)
+                root, parent = new_snippet_root(strip_whitespace(child.tail))
+                continue
+            parent.append(child)
+        roots.append(root)
+
+        return [
+            d(lxml.html.tostring(root, encoding = 'utf-8', method = 'html'))
+            for root in roots
+        ]
+
     def _fast_parse(self, wikitext):
         tokenizer = mwparserfromhell.parser.CTokenizer()
         try:
@@ -422,39 +758,97 @@ class SnippetParserBase(object):
         except mwparserfromhell.parser.ParserError:
             return None
 
-    def _to_html(self, snippet):
-        if self._wikipedia is None:
-            # Testing
-            return snippet
+    def _render_wikitext(self, wikitext):
+        """Renders wikitext into HTML using the API.
+
+        Returns None if rendering fails.
+        """
 
         params = {
             'action': 'parse',
-            'format': 'json',
-            'text': snippet,
+            'text': wikitext,
+            'disablelimitreport': 'true',
         }
-        request = wikitools.APIRequest(self._wikipedia, params)
-        # FIXME Sometimes the request fails because the text is too long;
-        # in that case, the API response is HTML, not JSON, which raises
-        # an exception when wikitools tries to parse it.
-        #
-        # Normally this would cause wikitools to happily retry forever
-        # (https://github.com/alexz-enwp/wikitools/blob/b71481796c350/wikitools/api.py#L304),
-        # which is a bug, but due to our use of a custom opener, wikitools'
-        # handling of the exception raises its own exception: the object returned
-        # by our opener doesnt support seek().
-        #
-        # We use that interesting coincidence to catch the exception and move
-        # on, bypassing wikitools' faulty retry, but this is obviously a terrible
-        # "solution".
+        # Sometimes the request fails because the text is too long; in that
+        # case, the API response is HTML, not JSON, and we just move on.
+        # Anything else, like a missing recording when replaying or the
+        # page running out of time in parse_live, must get through.
         try:
-            html = request.query()['parse']['text']['*']
-        except:
+            return self._wikipedia.query(params)['parse']['text']['*']
+        except (requests.RequestException, ValueError, KeyError,
+                wpapi.APIError):
+            return None
+
+    def _to_html(self, snippet):
+        if self._wikipedia is None:
+            # Testing
+            return snippet
+
+        html = self._render_wikitext(snippet)
+        if html is None:
             return ''
         return self._cleanup_snippet_html(html)
 
+    def _to_html_batch(self, snippets):
+        """Converts a list of snippets to HTML using as few API requests as
+        possible.
+
+        Snippets with simple enough markup are rendered locally, and snippets
+        found in the HTML cache are not rendered again. The others are joined
+        with SNIPPET_SEPARATOR and rendered together by the API, in batches of
+        at most HTML_BATCH_MAX_SIZE characters. If a batch can't be split back
+        into snippets, its snippets are rendered one by one.
+        """
+
+        if self._wikipedia is None:
+            # Testing
+            return list(snippets)
+
+        snippets = list(snippets)
+        cached = {}
+        if self._cfg.html_snippet_local_rendering:
+            for snippet in snippets:
+                html = render_wikitext(snippet)
+                if html is not None:
+                    cached[snippet] = self._cleanup_snippet_html(html)
+        if self._html_cache is not None:
+            cached.update(self._html_cache.get_many(
+                s for s in snippets if s not in cached))
+
+        batches = []
+        size = float('inf')
+        for snippet in snippets:
+            if snippet in cached:
+                continue
+            if size + len(snippet) > HTML_BATCH_MAX_SIZE:
+                batches.append([])
+                size = 0
+            batches[-1].append(snippet)
+            size += len(snippet) + len(SNIPPET_SEPARATOR)
+
+        htmls = []
+        for batch in batches:
+            batch_htmls = None
+            if len(batch) > 1:
+                html = self._render_wikitext(SNIPPET_SEPARATOR.join(batch))
+                if html is not None:
+                    batch_htmls = self._cleanup_snippets_html(html, len(batch))
+            if batch_htmls is None:
+                batch_htmls = [self._to_html(snippet) for snippet in batch]
+            htmls.extend(batch_htmls)
+
+        rendered = dict(zip(
+            (snippet for batch in batches for snippet in batch), htmls))
+        if self._html_cache is not None and rendered:
+            # Don't cache failures, the API may do better next time
+            self._html_cache.put_many(
+                (snippet, html) for snippet, html in rendered.items() if html)
+        rendered.update(cached)
+        return [rendered[snippet] for snippet in snippets]
+
 _log = Logger()
 
-def create_snippet_parser(wikipedia, cfg):
+def create_snippet_parser(wikipedia, cfg, citation_needed_templates = None):
     if os.path.dirname(__file__) not in sys.path:
         sys.path.append(os.path.dirname(__file__))
     try:
@@ -462,4 +856,5 @@ def create_snippet_parser(wikipedia, cfg):
     except ImportError:
         _log.info('No snippet_parser for lang_code %s, using stub!' % cfg.lang_code)
         localized_module = importlib.import_module('stub')
-    return localized_module.SnippetParser(wikipedia, cfg)
+    return localized_module.SnippetParser(
+        wikipedia, cfg, citation_needed_templates)
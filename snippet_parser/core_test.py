@@ -0,0 +1,227 @@
+#-*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+
+from core import *
+import wpapi
+
+import BaseHTTPServer
+import json
+import os
+import mock
+import shutil
+import tempfile
+import threading
+import unittest
+import urlparse
+
+class StubAPIRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''A very small subset of the MediaWiki API.'''
+
+    def do_GET(self):
+        self.respond(urlparse.parse_qs(urlparse.urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length'))
+        self.respond(urlparse.parse_qs(self.rfile.read(length)))
+
+    def respond(self, params):
+        params = {k: d(v[0]) for k, v in params.items()}
+        self.server.requests.append(params)
+        if params['action'] == 'parse':
+            response = {'parse': {'text': {'*': self.render(params['text'])}}}
+        elif params.get('prop') == 'redirects':
+            response = {'query': {'pages': {'1': {
+                'title': 'Template:Citation needed',
+                'redirects': [{'title': 'Template:Cn'}],
+            }}}}
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(response))
+
+    def render(self, wikitext):
+        html = ''.join(
+            '<p>%s\n</p>' % re.sub(
+                r'\[\[([^|\]]*)\|?([^\]]*)\]\]',
+                lambda m: '<a href="/wiki/%s">%s</a>' % (
+                    m.group(1), m.group(2) or m.group(1)), paragraph)
+            for paragraph in wikitext.split('\n\n'))
+        if 'disablelimitreport' not in self.server.requests[-1]:
+            html += '\n<!-- NewPP limit report -->\n'
+        return '<div class="mw-parser-output">' + html + '</div>'
+
+    def log_message(self, *args):
+        pass
+
+class ToHTMLBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(
+            ('localhost', 0), StubAPIRequestHandler)
+        self.server.requests = []
+        thread = threading.Thread(target = self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+
+        cfg = config.get_localized_config('ja')
+        cfg.snippet_min_size = 0
+        cfg.cache_dir = tempfile.mkdtemp(prefix = 'citationhunt_core_test_')
+        self.addCleanup(shutil.rmtree, cfg.cache_dir)
+        cfg.html_snippet_local_rendering = False
+        self.cfg = cfg
+        self.wiki = wpapi.WikipediaAPI(
+            'http://localhost:%d/w/api.php' % self.server.server_port)
+        self.snippet_parser = create_snippet_parser(self.wiki, cfg)
+        del self.server.requests[:]
+
+    def count_parse_requests(self):
+        return len([r for r in self.server.requests if r['action'] == 'parse'])
+
+    def test_single_request_per_page(self):
+        s = '\n\n'.join([
+            'This is the [[lead]] section.{{Citation needed}}',
+            'This one has [[a link|two]] links.{{Citation needed}}',
+            '==Section 1==',
+            'This is section 1.{{Citation needed}}',
+            'This paragraph has no template.',
+            'This is also section 1.{{Citation needed}}',
+        ])
+        snippets = self.snippet_parser.extract_snippets(s)
+        self.assertEqual(self.count_parse_requests(), 1)
+        self.assertEqual([len(snips) for _, snips in snippets], [2, 2])
+        self.assertEqual(snippets[0][1][1],
+            '<div><div class="mw-parser-output"><p>This one has two links.' +
+            CITATION_NEEDED_MARKER + '\n</p></div></div>')
+
+    def test_iter_extract(self):
+        s = '\n\n'.join([
+            'This is the [[lead]] section.{{Citation needed}}',
+            '==Section 1==',
+            'This is section 1.{{Citation needed}}',
+        ])
+        self.assertEqual(
+            list(self.snippet_parser.iter_extract(s)),
+            [(sec, sni) for sec, snips in self.snippet_parser.extract(s)
+             for sni in snips])
+        self.assertEqual(self.count_parse_requests(), 1)
+
+    def test_html_cache(self):
+        s = '\n\n'.join([
+            'This is the lead section.{{Citation needed}}',
+            'This is another paragraph.{{Citation needed}}',
+        ])
+        snippets = self.snippet_parser.extract_snippets(s)
+        self.assertEqual(self.count_parse_requests(), 1)
+        self.assertEqual(self.snippet_parser.extract_snippets(s), snippets)
+        self.assertEqual(self.count_parse_requests(), 1)
+
+        # Only the new paragraph needs to be rendered
+        self.assertEqual(len(self.snippet_parser.extract_snippets(
+            s + '\n\nThis one is new.{{Citation needed}}')[0][1]), 3)
+        self.assertEqual(self.count_parse_requests(), 2)
+        self.assertEqual(self.server.requests[-1]['text'],
+            'This one is new.' + CITATION_NEEDED_MARKER)
+
+    def test_same_html_as_single_requests(self):
+        snippets = [
+            'A [[link]] and a marker' + CITATION_NEEDED_MARKER,
+            'Another snippet' + CITATION_NEEDED_MARKER,
+            'A third one.',
+        ]
+        self.assertEqual(
+            self.snippet_parser._to_html_batch(snippets),
+            [self.snippet_parser._to_html(s) for s in snippets])
+        self.assertEqual(self.count_parse_requests(), 1 + len(snippets))
+
+    def test_local_rendering(self):
+        self.snippet_parser._cfg.html_snippet_local_rendering = True
+        snippets = [
+            'A simple snippet' + CITATION_NEEDED_MARKER,
+            'Another snippet, with a & and a <' + CITATION_NEEDED_MARKER,
+            'A snippet with a {{template}}' + CITATION_NEEDED_MARKER,
+        ]
+        self.assertEqual(
+            self.snippet_parser._to_html_batch(snippets),
+            [self.snippet_parser._to_html(s) for s in snippets])
+        # Only one of the four requests came from _to_html_batch
+        self.assertEqual(self.count_parse_requests(), 1 + len(snippets))
+        self.assertEqual(self.server.requests[0]['text'], snippets[2])
+
+    def test_citation_needed_templates_cache(self):
+        def count_redirects_requests():
+            return len([r for r in self.server.requests
+                        if r.get('prop') == 'redirects'])
+
+        # The snippet parser already populated the cache in setUp
+        self.assertEqual(
+            load_citation_needed_templates(self.wiki, self.cfg),
+            set(['Citation needed', 'Cn']))
+        self.assertEqual(count_redirects_requests(), 0)
+        create_snippet_parser(self.wiki, self.cfg)
+        self.assertEqual(count_redirects_requests(), 0)
+
+        load_citation_needed_templates(self.wiki, self.cfg, refresh = True)
+        self.assertEqual(count_redirects_requests(), 1)
+
+        self.cfg.citation_needed_templates_cache_hours = 0
+        load_citation_needed_templates(self.wiki, self.cfg)
+        self.assertEqual(count_redirects_requests(), 2)
+
+    def test_same_html_as_single_requests_realistic(self):
+        # Like the responses to action=parse, with a newline between block
+        # elements but not after the last one
+        def mw_html(*paragraphs):
+            return '<div class="mw-parser-output">' + '\n'.join(
+                '<p>%s\n</p>' % p for p in paragraphs) + '</div>'
+
+        snippets = [
+            ('A <a href="/wiki/Link" title="Link">link</a> and a marker' +
+                CITATION_NEEDED_MARKER,),
+            ('Another snippet' + CITATION_NEEDED_MARKER,),
+            ('A third one.', 'In two paragraphs.'),
+        ]
+        batched = mw_html(*sum(
+            [list(s) + [SNIPPET_SEPARATOR_MARKER] for s in snippets], [])[:-1])
+        self.assertEqual(
+            self.snippet_parser._cleanup_snippets_html(batched, len(snippets)),
+            [self.snippet_parser._cleanup_snippet_html(mw_html(*s))
+             for s in snippets])
+
+    def test_render_wikitext_errors(self):
+        with mock.patch.object(self.wiki, 'query',
+                return_value = {'error': {}}):
+            self.assertIsNone(self.snippet_parser._render_wikitext('A'))
+
+        # Like parse_live's PageBudgetExceeded, raised by a signal handler
+        class BudgetExceeded(BaseException):
+            pass
+        for exception in (BudgetExceeded, RuntimeError):
+            with mock.patch.object(self.wiki, 'query',
+                    side_effect = exception()):
+                self.assertRaises(exception,
+                    self.snippet_parser._render_wikitext, 'A')
+
+    def test_replay_not_recorded(self):
+        store = wpapi.ResponseStore(
+            os.path.join(self.cfg.cache_dir, 'responses.sqlite'))
+        def make_api(mode):
+            return wpapi.WikipediaAPI(
+                self.wiki.api_url, mode = mode, store = store)
+        self.snippet_parser._html_cache = None
+        self.snippet_parser._wikipedia = make_api(wpapi.RECORD)
+        recorded = self.snippet_parser._to_html_batch(['A', 'B'])
+
+        self.snippet_parser._wikipedia = make_api(wpapi.REPLAY)
+        self.assertEqual(
+            self.snippet_parser._to_html_batch(['A', 'B']), recorded)
+        self.assertRaises(wpapi.NotRecordedError,
+            self.snippet_parser._to_html_batch, ['A', 'C'])
+
+    def test_cannot_split(self):
+        html = '<div><p>A</p><div><p>%s</p></div><p>%s</p><p>B</p></div>' % (
+            SNIPPET_SEPARATOR_MARKER, SNIPPET_SEPARATOR_MARKER)
+        self.assertIsNone(self.snippet_parser._cleanup_snippets_html(html, 3))
+        self.assertIsNone(self.snippet_parser._cleanup_snippets_html(html, 2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -119,6 +119,41 @@ class ExtractSnippetTest(unittest.TestCase):
         self.assertEqual((snippets[1][0], len(snippets[1][1])), ('Section 1', 1))
         self.assertEqual((snippets[2][0], len(snippets[2][1])), ('Section 2', 1))
 
+    def test_iter_extract(self):
+        s = '\n'.join([
+            'This is the lead section. It requires one citation{{cn}}.',
+            '==Section 1==',
+            '==Section 2==',
+            'This is section 2{{cn}}.',
+            '',
+            'This is also section 2{{cn}}.',
+        ])
+
+        self.assertEqual(
+            list(snippet_parser.iter_extract(s)),
+            [(sec, sni) for sec, snips in extract_snippets(s) for sni in snips])
+        self.assertEqual(
+            [sec for sec, _ in snippet_parser.iter_extract(s)],
+            ['', 'Section 2', 'Section 2'])
+        self.assertEqual(
+            list(snippet_parser.iter_extract(
+                s, lambda sec, sni: 'also' in sni)),
+            [('Section 2', 'This is also section 2' + CITATION_NEEDED_MARKER + '.')])
+
+    def test_iter_extract_is_lazy(self):
+        s = 'This is the lead section{{cn}}.\n==Section 1==\n{{cn}}Broken'
+        parsed = []
+        original_strip_paragraph = snippet_parser._fast_strip_paragraph
+        def strip_paragraph(paragraph):
+            parsed.append(paragraph)
+            return original_strip_paragraph(paragraph)
+        snippet_parser._fast_strip_paragraph = strip_paragraph
+        try:
+            next(snippet_parser.iter_extract(s))
+        finally:
+            del snippet_parser._fast_strip_paragraph
+        self.assertEqual(len(parsed), 1)
+
     def test_strip_spaces_before_citation_needed(self):
         s = 'This is a paragraph with spaces before the template%s%s.'
 
@@ -176,5 +211,62 @@ class ExtractSnippetTest(unittest.TestCase):
             extract_lead_snippets(s),
             ['BC is a province in Canada' + CITATION_NEEDED_MARKER])
 
+class FastPathTest(unittest.TestCase):
+    def assertSameAsSlowPath(self, paragraph):
+        stripped = snippet_parser._fast_strip_paragraph(paragraph)
+        self.assertIsNotNone(stripped)
+        self.assertEqual(stripped, snippet_parser._strip_code(
+            mwparserfromhell.parse(paragraph)))
+
+    def test_simple_paragraph(self):
+        self.assertSameAsSlowPath(
+            'Australia produces a wide variety of [[fruit]], '
+            '[[nut (fruit)|nut]]s and [[vegetable]]s.<ref name="a"/> '
+            'The largest crops<ref>{{cite web|url=http://example.com}}</ref> '
+            'include [[orange (fruit)|orange]]s.<!-- comment -->'
+            '{{Citation needed|date=November 2008}}')
+
+    def test_simple_templates(self):
+        self.assertSameAsSlowPath(
+            '{{flag|British Columbia|name=BC}} is a province in '
+            '{{flag|Canada}}{{cn}}, and the tower is {{Convert|324|m}} tall.')
+
+    def test_file_link(self):
+        self.assertSameAsSlowPath(
+            '[[File:wiki.png]]This needs a citation.{{cn}}')
+
+    def test_fallback(self):
+        for paragraph in [
+            "'''Bold''' text.{{cn}}",
+            'Text with [http://example.com an external link].{{cn}}',
+            'Text with a free link http://example.com{{cn}}',
+            'Text with {{nested|{{templates}}}}.{{cn}}',
+            '*A list item{{cn}}',
+            'An entity&ndash;here{{cn}}',
+            'Some <b>HTML</b>.{{cn}}',
+            'A blacklisted {{lang|fr|template}}.{{cn}}',
+            'A blacklisted template <ref>{{lang|fr|x}}</ref>.{{cn}}',
+        ]:
+            self.assertIsNone(
+                snippet_parser._fast_strip_paragraph(paragraph), paragraph)
+
+    def test_same_snippets_without_fast_path(self):
+        slow_cfg = config.get_localized_config('en')
+        slow_cfg.citation_needed_templates = cfg.citation_needed_templates
+        slow_cfg.snippet_min_size = 0
+        slow_cfg.snippet_max_size = float('inf')
+        slow_cfg.snippet_parser_fast_path = False
+        slow_snippet_parser = create_snippet_parser(None, slow_cfg)
+
+        s = '\n\n'.join([
+            'This is the [[lead]] section.<ref>A reference</ref>{{cn}}',
+            "This one has '''bold''' text{{cn}}.",
+            '==Section 1==',
+            'This is section 1{{cn}}. It has a {{lang|fr|blacklisted}} template.',
+            'This is also section 1{{cn}}.',
+        ])
+        self.assertEqual(
+            extract_snippets(s), slow_snippet_parser.extract_snippets(s))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,140 @@
+#-*- encoding: utf-8 -*-
+'''
+A local wikitext to HTML renderer for the simple markup commonly found in
+snippets: paragraphs, bold and italics and single-level lists.
+
+This lets us skip the Wikipedia API for most snippets when html_snippet is
+True. It renders the same HTML the API would for that subset of wikitext, and
+refuses to render anything else (templates, links, tags, ...).
+'''
+
+from __future__ import unicode_literals
+
+import mwparserfromhell
+
+import cgi
+import re
+
+# Potential URI schemes, which could start a free external link.
+SCHEME_REGEXP = re.compile('([a-zA-Z][a-zA-Z0-9+.\\-]*):')
+
+# Markup we don't render: templates, links, tags, entities, behavior switches,
+# signatures and magic links.
+UNSUPPORTED_MARKUP_REGEXP = re.compile(
+    '[{}\\[\\]]|<[a-zA-Z/!]|&#?[a-zA-Z0-9]+;|__|~~~|\\b(?:ISBN|RFC|PMID)\\s',
+    re.UNICODE)
+
+# Runs of apostrophes, which may be bold or italic markup
+QUOTES_REGEXP = re.compile("'{2,}")
+
+# MediaWiki's Sanitizer::armorFrenchSpaces
+FRENCH_SPACES_REGEXPS = [
+    (re.compile(' (?=[?:;!%\xbb\u203a](?![a-zA-Z0-9_]))', re.UNICODE), '\xa0'),
+    (re.compile('([\xab\u2039]) ', re.UNICODE), '\\1\xa0'),
+]
+
+LIST_TAGS = {'*': 'ul', '#': 'ol'}
+
+def may_contain_free_link(text):
+    for m in SCHEME_REGEXP.finditer(text):
+        scheme = m.group(1).lower()
+        if any(scheme[i:] in mwparserfromhell.definitions.URI_SCHEMES
+               for i in range(len(scheme))):
+            return True
+    return False
+
+def _render_inline(line):
+    '''Renders the bold and italic markup in a line of text.
+
+    Returns None if the quotes can't be paired up trivially, in which case
+    MediaWiki applies some heuristics we don't replicate.
+    '''
+
+    runs = QUOTES_REGEXP.findall(line)
+    if any(len(r) > 3 for r in runs):
+        return None
+    if runs.count("''") % 2 or runs.count("'''") % 2:
+        return None
+
+    html = []
+    open_tags = []
+    pos = 0
+    for m in QUOTES_REGEXP.finditer(line):
+        html.append(cgi.escape(line[pos:m.start()]))
+        pos = m.end()
+        tag = 'i' if m.group() == "''" else 'b'
+        if tag in open_tags:
+            if open_tags[-1] != tag:
+                return None
+            open_tags.pop()
+            html.append('</%s>' % tag)
+        else:
+            open_tags.append(tag)
+            html.append('<%s>' % tag)
+    html.append(cgi.escape(line[pos:]))
+    return ''.join(html)
+
+def _split_blocks(wikitext):
+    '''Splits wikitext into a list of (tag, [line, ...]) blocks, where tag is
+    'p', 'ul' or 'ol'. Returns None for unsupported block markup.
+    '''
+
+    blocks = []
+    for line in wikitext.split('\n'):
+        if not line.strip():
+            if blocks and blocks[-1][0] is None:
+                # MediaWiki turns extra blank lines into <p><br />, which we
+                # leave to the API
+                return None
+            blocks.append((None, []))  # ends the current block
+            continue
+        if line[0] in LIST_TAGS:
+            if line[1:2] in '*#:;':
+                # nested lists or empty items
+                return None
+            tag, line = LIST_TAGS[line[0]], line[1:].strip()
+        elif line[0] in ' :;=' or line.startswith('----'):
+            # preformatted text, definition lists, headings and rules
+            return None
+        else:
+            tag = 'p'
+        if not blocks or blocks[-1][0] != tag:
+            blocks.append((tag, []))
+        blocks[-1][1].append(line)
+    return [b for b in blocks if b[0] is not None]
+
+def render_wikitext(wikitext):
+    '''Renders wikitext into HTML like the Wikipedia API would.
+
+    Returns None if the wikitext contains markup we can't render.
+    '''
+
+    if UNSUPPORTED_MARKUP_REGEXP.search(wikitext):
+        return None
+    if ':' in wikitext and may_contain_free_link(wikitext):
+        return None
+
+    blocks = _split_blocks(wikitext)
+    if blocks is None:
+        return None
+
+    html = []
+    for tag, lines in blocks:
+        rendered = []
+        for line in lines:
+            for regexp, replacement in FRENCH_SPACES_REGEXPS:
+                line = regexp.sub(replacement, line)
+            line = _render_inline(line)
+            if line is None:
+                return None
+            rendered.append(line)
+        if tag == 'p':
+            html.append('<p>' + '\n'.join(rendered) + '\n</p>')
+        else:
+            if html and html[-1].endswith('</p>'):
+                # MediaWiki closes paragraphs with a newline when opening
+                # a list
+                html.append('\n')
+            html.append('<%s>%s</%s>\n' % (tag, '\n'.join(
+                '<li>' + line + '</li>' for line in rendered), tag))
+    return '<div class="mw-parser-output">' + ''.join(html) + '</div>'
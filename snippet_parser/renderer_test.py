@@ -0,0 +1,63 @@
+#-*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+
+from renderer import *
+
+import unittest
+
+def wrap(html):
+    return '<div class="mw-parser-output">' + html + '</div>'
+
+class RenderWikitextTest(unittest.TestCase):
+    def test_paragraphs(self):
+        self.assertEqual(render_wikitext('A paragraph & a < b'),
+            wrap('<p>A paragraph &amp; a &lt; b\n</p>'))
+        self.assertEqual(render_wikitext('One\ntwo\n\nThree'),
+            wrap('<p>One\ntwo\n</p><p>Three\n</p>'))
+
+    def test_blank_lines(self):
+        # MediaWiki renders extra blank lines as <p><br />, which we leave to
+        # the API
+        self.assertIsNone(render_wikitext('a\n\n\nb'))
+        self.assertIsNone(render_wikitext('* a\n\n\n\nb'))
+
+    def test_bold_and_italics(self):
+        self.assertEqual(
+            render_wikitext("'''日本'''は''東アジアに'''位置'''する''"),
+            wrap('<p><b>日本</b>は<i>東アジアに<b>位置</b>する</i>\n</p>'))
+
+    def test_unsupported_quotes(self):
+        self.assertIsNone(render_wikitext("'''''Bold italics'''''"))
+        self.assertIsNone(render_wikitext("'''Bold''' and ''italics"))
+        self.assertIsNone(render_wikitext("'''Bold ''and''' italics''"))
+
+    def test_lists(self):
+        self.assertEqual(render_wikitext('* One\n*Two\n\n# Three'),
+            wrap('<ul><li>One</li>\n<li>Two</li></ul>\n'
+                 '<ol><li>Three</li></ol>\n'))
+        self.assertEqual(render_wikitext('Some items:\n* One'),
+            wrap('<p>Some items:\n</p>\n<ul><li>One</li></ul>\n'))
+        self.assertIsNone(render_wikitext('* One\n** Two'))
+        self.assertIsNone(render_wikitext('; Term\n: Definition'))
+
+    def test_french_spaces(self):
+        self.assertEqual(render_wikitext('« Quoi ? »'),
+            wrap('<p>«\xa0Quoi\xa0?\xa0»\n</p>'))
+
+    def test_unsupported_markup(self):
+        for wikitext in [
+            'A {{template}}',
+            'A [[link]]',
+            'An [http://example.com external link]',
+            'A free link: http://example.com',
+            'A <span>tag</span>',
+            'An &ndash; entity',
+            '__NOTOC__',
+            'ISBN 0-306-40615-2',
+            '== A heading ==',
+            ' Preformatted',
+        ]:
+            self.assertIsNone(render_wikitext(wikitext), wikitext)
+
+if __name__ == '__main__':
+    unittest.main()
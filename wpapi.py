@@ -0,0 +1,348 @@
+'''
+A small client for the MediaWiki API of Wikipedia.
+
+It keeps one keep-alive session per process, asks for gzipped responses,
+sets maxlag and backs off when the API asks us to, and follows continuations
+explicitly. Pages are fetched in batches sized by their length, so we get as
+much content as possible per request without going over the API's limits.
+
+Responses can also be recorded to a compressed store on disk and replayed
+later, so runs can be repeated and benchmarked without the network.
+'''
+
+from __future__ import unicode_literals
+
+import os
+import sys
+
+_upper_dir = os.path.abspath(os.path.dirname(__file__))
+if _upper_dir not in sys.path:
+    sys.path.append(_upper_dir)
+
+from utils import *
+
+import requests
+import requests.adapters
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+USER_AGENT = 'citationhunt (https://tools.wmflabs.org/citationhunt)'
+
+# See https://www.mediawiki.org/wiki/Manual:Maxlag_parameter
+DEFAULT_MAXLAG = 5
+MAX_RETRIES = 5
+REQUEST_TIMEOUT = 120
+
+# The most pageids or titles the API accepts in a single query, for clients
+# without the apihighlimits right
+MAX_PAGES_PER_QUERY = 50
+
+# The most page content, in bytes, we ask for in a single query. The API
+# returns at most $wgAPIMaxResultSize (8MB by default) per response and
+# continues from there, so stay well under it.
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+
+# How many connections each session keeps open, at most one per thread
+CONNECTIONS_PER_SESSION = 16
+
+# What to do with the responses in the store: ignore it, record all responses
+# to it, only replay responses from it, or replay the responses it has and
+# fetch and record the others.
+LIVE = 'live'
+RECORD = 'record'
+REPLAY = 'replay'
+REPLAY_OR_FETCH = 'replay-or-fetch'
+MODES = (LIVE, RECORD, REPLAY, REPLAY_OR_FETCH)
+
+# Parameters that don't change the response
+VOLATILE_PARAMS = ('format', 'maxlag')
+
+class APIError(Exception):
+    def __init__(self, code, info):
+        super(APIError, self).__init__('%s: %s' % (code, info))
+        self.code = code
+        self.info = info
+
+class NotRecordedError(Exception):
+    '''Raised when replaying a request that wasn't recorded.'''
+    pass
+
+class ResponseStore(object):
+    '''API responses stored in SQLite, compressed, keyed by a hash of the
+    request parameters.
+
+    The store may be shared by many processes.
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+
+    def _get_db(self):
+        # Like sessions, SQLite connections don't survive a fork
+        if self._db_pid != os.getpid():
+            mkdir_p(os.path.dirname(self._path))
+            self._db = sqlite3.connect(
+                self._path, timeout = 60, check_same_thread = False)
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY,
+                response BLOB)''')
+            self._db.commit()
+            self._db_pid = os.getpid()
+        return self._db
+
+    def key(self, params):
+        normalized = sorted(
+            (d(k), d(v) if isinstance(v, basestring) else unicode(v))
+            for k, v in params.items() if k not in VOLATILE_PARAMS)
+        return hashlib.sha1(e(json.dumps(normalized))).hexdigest()
+
+    def get(self, params):
+        '''Returns the recorded response to a request, or None.'''
+
+        with self._lock:
+            row = self._get_db().execute(
+                'SELECT response FROM responses WHERE key = ?',
+                (self.key(params),)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, params, response):
+        blob = sqlite3.Binary(zlib.compress(json.dumps(response)))
+        with self._lock:
+            db = self._get_db()
+            with db:
+                db.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?, ?)',
+                    (self.key(params), blob))
+
+def batches(items, n):
+    items = list(items)
+    return [items[i:i+n] for i in range(0, len(items), n)]
+
+def batch_by_length(lengths, max_bytes = MAX_BATCH_BYTES,
+                    max_pages = MAX_PAGES_PER_QUERY):
+    '''Splits the pages in `lengths`, a dict pageid -> length in bytes, into
+    batches of at most `max_pages` pages and `max_bytes` bytes, largest pages
+    first. Pages larger than `max_bytes` get a batch of their own.
+    '''
+
+    result = []
+    batch, batch_bytes = [], 0
+    for pageid in sorted(lengths, key = lengths.get, reverse = True):
+        if batch and (len(batch) == max_pages or
+            batch_bytes + lengths[pageid] > max_bytes):
+            result.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(pageid)
+        batch_bytes += lengths[pageid]
+    if batch:
+        result.append(batch)
+    return result
+
+def _page_to_tuple(pageid, page):
+    revision = page['revisions'][0]
+    return (d(pageid), d(page['title']), d(revision['*']), revision['revid'])
+
+class WikipediaAPI(object):
+    def __init__(self, api_url, maxlag = DEFAULT_MAXLAG,
+                 max_batch_bytes = MAX_BATCH_BYTES, mode = LIVE,
+                 store = None):
+        assert mode in MODES
+        assert mode == LIVE or store is not None
+        self.api_url = api_url
+        self.maxlag = maxlag
+        self.max_batch_bytes = max_batch_bytes
+        self.mode = mode
+        self.store = store
+        self._lock = threading.Lock()
+        self._session = None
+        self._session_pid = None
+
+    def _get_session(self):
+        # Sessions don't survive a fork, so each process makes its own
+        with self._lock:
+            if self._session_pid != os.getpid():
+                session = requests.Session()
+                session.headers.update({
+                    'User-Agent': USER_AGENT,
+                    'Accept-Encoding': 'gzip',
+                })
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_maxsize = CONNECTIONS_PER_SESSION)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+                self._session_pid = os.getpid()
+            return self._session
+
+    def _wait_before_retry(self, attempt, response = None):
+        delay = 2 ** attempt
+        if response is not None:
+            try:
+                delay = int(response.headers.get('Retry-After', delay))
+            except ValueError:
+                pass
+        time.sleep(delay)
+
+    def query(self, params):
+        '''Makes an API request and returns the decoded JSON response.
+
+        Requests are retried, with backoff, when the servers are lagged or
+        overloaded or the connection fails. API errors raise APIError.
+        Depending on self.mode, the response may come from, or be recorded
+        to, self.store.
+        '''
+
+        if self.mode in (REPLAY, REPLAY_OR_FETCH):
+            response = self.store.get(params)
+            if response is not None:
+                return response
+            if self.mode == REPLAY:
+                raise NotRecordedError(params)
+        response = self._fetch(params)
+        if self.mode != LIVE:
+            self.store.put(params, response)
+        return response
+
+    def _fetch(self, params):
+        params = dict(params)
+        params['format'] = 'json'
+        if self.maxlag is not None:
+            params['maxlag'] = self.maxlag
+        for attempt in range(MAX_RETRIES + 1):
+            retry = attempt < MAX_RETRIES
+            try:
+                # POST, as the text we send to action=parse can get too long
+                # for a URL
+                response = self._get_session().post(
+                    self.api_url, data = params, timeout = REQUEST_TIMEOUT)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                if not retry:
+                    raise
+                self._wait_before_retry(attempt)
+                continue
+
+            if response.status_code in (429, 503) and retry:
+                self._wait_before_retry(attempt, response)
+                continue
+            response.raise_for_status()
+            result = response.json()
+            if 'error' in result:
+                code = result['error'].get('code')
+                if code == 'maxlag' and retry:
+                    self._wait_before_retry(attempt, response)
+                    continue
+                raise APIError(code, result['error'].get('info'))
+            return result
+
+    def query_continue(self, params):
+        '''Yields each response to a query, following its continuations.'''
+
+        params = dict(params)
+        params['continue'] = ''
+        while True:
+            result = self.query(params)
+            yield result
+            if 'continue' not in result:
+                break
+            params.update(result['continue'])
+
+    def get_page_info(self, pageids):
+        '''Returns a dict pageid -> (length in bytes, revision id) of the
+        latest revision, for the pages in `pageids` that exist.'''
+
+        info = {}
+        for batch in batches(pageids, MAX_PAGES_PER_QUERY):
+            for result in self.query_continue({
+                'action': 'query',
+                'prop': 'info',
+                'pageids': '|'.join(map(unicode, batch)),
+            }):
+                for pageid, page in result['query']['pages'].items():
+                    if 'missing' not in page and 'length' in page:
+                        info[d(pageid)] = (page['length'], page['lastrevid'])
+        return info
+
+    def get_page_lengths(self, pageids):
+        '''Returns a dict pageid -> length in bytes of the latest revision,
+        for the pages in `pageids` that exist.'''
+
+        return {pageid: length for pageid, (length, _)
+                in self.get_page_info(pageids).items()}
+
+    def _get_pages_batch(self, pageids):
+        pages = {}
+        for result in self.query_continue({
+            'action': 'query',
+            'prop': 'revisions',
+            'rvprop': 'ids|content',
+            'pageids': '|'.join(pageids),
+        }):
+            # When continuing, the pages we already got come back again, but
+            # without their revisions
+            for pageid, page in result['query']['pages'].items():
+                if page.get('revisions') and '*' in page['revisions'][0]:
+                    pages[d(pageid)] = _page_to_tuple(pageid, page)
+        return pages
+
+    def get_pages(self, pageids, lengths = None):
+        '''Fetches the wikitext of the latest revision of each page.
+
+        Returns a list of (pageid, title, wikitext, revision id) tuples and a
+        list of the pageids that couldn't be fetched, because the page was
+        deleted or its content is hidden. The pages are first looked up to
+        find their sizes, unless given in `lengths` as returned by
+        get_page_lengths, then fetched in batches of up to
+        self.max_batch_bytes.
+        '''
+
+        pageids = map(unicode, pageids)
+        if lengths is None:
+            lengths = self.get_page_lengths(pageids)
+        pages = {}
+        for batch in batch_by_length(
+            {d(p): l for p, l in lengths.items()}, self.max_batch_bytes):
+            pages.update(self._get_pages_batch(batch))
+        return ([pages[p] for p in pageids if p in pages],
+                [p for p in pageids if p not in pages])
+
+    def get_page_by_title(self, title):
+        '''Returns the (pageid, title, wikitext, revision id) of the latest
+        revision of the page with `title`, following redirects, or None if
+        there is no such page.'''
+
+        result = self.query({
+            'action': 'query',
+            'prop': 'revisions',
+            'rvprop': 'ids|content',
+            'titles': title,
+            'redirects': '',
+        })
+        for pageid, page in result['query']['pages'].items():
+            if page.get('revisions'):
+                return _page_to_tuple(pageid, page)
+        return None
+
+def create_wikipedia_api(cfg, mode = None):
+    '''Creates a WikipediaAPI for a language, using the store in
+    cfg.cache_dir in cfg.wikipedia_api_mode, unless given another `mode`.'''
+
+    mode = mode or cfg.wikipedia_api_mode
+    store = None
+    if mode != LIVE:
+        assert cfg.cache_dir, 'Recording API responses needs a cache_dir'
+        store = ResponseStore(os.path.join(
+            cfg.cache_dir, 'api_responses_%s.sqlite' % cfg.lang_code))
+    return WikipediaAPI(
+        'https://' + cfg.wikipedia_domain + '/w/api.php',
+        mode = mode, store = store)
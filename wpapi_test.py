@@ -0,0 +1,186 @@
+from __future__ import unicode_literals
+
+import wpapi
+
+import BaseHTTPServer
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urlparse
+
+class StubAPIRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Just enough of action=query to fetch pages.'''
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length'))
+        params = {k: v[0].decode('utf-8') for k, v in
+                  urlparse.parse_qs(self.rfile.read(length)).items()}
+        self.server.requests.append(params)
+
+        if self.server.lagged:
+            self.server.lagged -= 1
+            self.respond({'error': {'code': 'maxlag', 'info': 'lagged'}},
+                         {'Retry-After': '0'})
+            return
+
+        pages = {}
+        for pageid in params['pageids'].split('|'):
+            if pageid not in self.server.pages:
+                pages[pageid] = {'pageid': int(pageid), 'missing': ''}
+                continue
+            title, text = self.server.pages[pageid]
+            pages[pageid] = {'pageid': int(pageid), 'title': title}
+            if params['prop'] == 'info':
+                pages[pageid]['length'] = len(text)
+                pages[pageid]['lastrevid'] = int(pageid) + 1000
+        response = {'query': {'pages': pages}}
+
+        if params['prop'] == 'revisions':
+            # Like the API, return the content of at most a few pages per
+            # response, and continue from there
+            pageids = sorted(pages, key = int)
+            start = int(params.get('rvcontinue', 0))
+            end = start + self.server.pages_per_response
+            for pageid in pageids[start:end]:
+                if 'missing' not in pages[pageid]:
+                    pages[pageid]['revisions'] = [{
+                        'revid': int(pageid) + 1000,
+                        '*': self.server.pages[pageid][1]}]
+            if end < len(pageids):
+                response['continue'] = {
+                    'rvcontinue': unicode(end), 'continue': '||'}
+        self.respond(response)
+
+    def respond(self, response, headers = {}):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(json.dumps(response))
+
+    def log_message(self, *args):
+        pass
+
+class WikipediaAPITest(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(
+            ('localhost', 0), StubAPIRequestHandler)
+        self.server.requests = []
+        self.server.lagged = 0
+        self.server.pages_per_response = 100
+        self.server.pages = {
+            unicode(i): ('Page %d' % i, 'x' * i * 10) for i in range(1, 11)}
+        thread = threading.Thread(target = self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+
+        self.api = wpapi.WikipediaAPI(
+            'http://localhost:%d/w/api.php' % self.server.server_port,
+            max_batch_bytes = 100)
+
+    def content_requests(self):
+        return [r for r in self.server.requests if r['prop'] == 'revisions']
+
+    def test_get_pages(self):
+        pages, missing = self.api.get_pages(['3', '42', '1', '2'])
+        self.assertEqual(pages, [
+            ('3', 'Page 3', 'x' * 30, 1003), ('1', 'Page 1', 'x' * 10, 1001),
+            ('2', 'Page 2', 'x' * 20, 1002)])
+        self.assertEqual(missing, ['42'])
+        for r in self.server.requests:
+            self.assertEqual(r['format'], 'json')
+            self.assertEqual(r['maxlag'], unicode(wpapi.DEFAULT_MAXLAG))
+
+    def test_batches_by_size(self):
+        pageids = map(unicode, range(1, 11))
+        pages, missing = self.api.get_pages(pageids)
+        self.assertEqual([p[0] for p in pages], pageids)
+        self.assertEqual(missing, [])
+        # Largest first, packing as many pages as fit in 100 bytes
+        self.assertEqual(
+            [r['pageids'] for r in self.content_requests()],
+            ['10', '9', '8', '7', '6', '5|4', '3|2|1'])
+
+    def test_get_page_info(self):
+        self.assertEqual(self.api.get_page_info(['1', '2', '42']),
+                         {'1': (10, 1001), '2': (20, 1002)})
+
+    def test_known_lengths(self):
+        lengths = self.api.get_page_lengths(['1', '2', '42'])
+        self.assertEqual(lengths, {'1': 10, '2': 20})
+        del self.server.requests[:]
+        pages, missing = self.api.get_pages(['1', '2', '42'], lengths)
+        self.assertEqual([p[0] for p in pages], ['1', '2'])
+        self.assertEqual(missing, ['42'])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_batch_by_length(self):
+        self.assertEqual(
+            wpapi.batch_by_length(
+                {'a': 5, 'b': 50, 'c': 20, 'd': 30, 'e': 1}, max_bytes = 50),
+            [['b'], ['d', 'c'], ['a', 'e']])
+        self.assertEqual(
+            wpapi.batch_by_length(
+                {'a': 1, 'b': 2, 'c': 3}, max_bytes = 50, max_pages = 2),
+            [['c', 'b'], ['a']])
+
+    def test_continuation(self):
+        self.server.pages_per_response = 2
+        self.api.max_batch_bytes = 1000
+        pages, missing = self.api.get_pages(map(unicode, range(1, 11)))
+        self.assertEqual(len(pages), 10)
+        self.assertEqual(missing, [])
+        self.assertEqual(len(self.content_requests()), 5)
+
+    def test_maxlag(self):
+        self.server.lagged = 2
+        pages, _ = self.api.get_pages(['1'])
+        self.assertEqual(pages, [('1', 'Page 1', 'x' * 10, 1001)])
+
+        self.server.lagged = wpapi.MAX_RETRIES + 1
+        with self.assertRaises(wpapi.APIError):
+            self.api.get_pages(['1'])
+
+class RecordReplayTest(WikipediaAPITest):
+    def setUp(self):
+        super(RecordReplayTest, self).setUp()
+        tmpdir = tempfile.mkdtemp(prefix = 'citationhunt_wpapi_test_')
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.store = wpapi.ResponseStore(
+            os.path.join(tmpdir, 'responses.sqlite'))
+        self.api = self.make_api(wpapi.RECORD)
+
+    def make_api(self, mode):
+        return wpapi.WikipediaAPI(
+            'http://localhost:%d/w/api.php' % self.server.server_port,
+            max_batch_bytes = 100, mode = mode, store = self.store)
+
+    def test_replay(self):
+        recorded = self.api.get_pages(['1', '2', '42'])
+        nrequests = len(self.server.requests)
+
+        # Replaying doesn't go to the server, and the store is keyed by the
+        # request parameters other than maxlag
+        api = self.make_api(wpapi.REPLAY)
+        api.maxlag = None
+        self.assertEqual(api.get_pages(['1', '2', '42']), recorded)
+        self.assertEqual(len(self.server.requests), nrequests)
+        with self.assertRaises(wpapi.NotRecordedError):
+            api.get_pages(['3'])
+
+    def test_replay_or_fetch(self):
+        self.api.get_pages(['1'])
+        api = self.make_api(wpapi.REPLAY_OR_FETCH)
+        nrequests = len(self.server.requests)
+        self.assertEqual(len(api.get_pages(['1', '3'])[0]), 2)
+        self.assertEqual(len(self.server.requests), nrequests + 2)
+        self.assertEqual(len(api.get_pages(['1', '3'])[0]), 2)
+        self.assertEqual(len(self.server.requests), nrequests + 2)
+
+if __name__ == '__main__':
+    unittest.main()